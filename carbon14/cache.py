@@ -0,0 +1,147 @@
+from collections import OrderedDict
+from hashlib import sha256
+from inspect import isawaitable
+from threading import Lock
+from time import time
+from uuid import uuid4
+
+from .utils import pk_of
+
+
+class LRUCache:
+    """Thread safe least recently used cache with hit/miss statistics
+
+    It is bounded by the number of entries and, when `max_bytes` is given,
+    by the approximate size of the entries as reported to `set`. Entries set
+    with a `ttl` (in seconds) expire after it.
+    """
+
+    def __init__(self, max_entries=128, max_bytes=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()
+        self.lock = Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.bytes = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            try:
+                value, size, expires = self.entries[key]
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires is not None and expires <= time():
+                del self.entries[key]
+                self.bytes -= size
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, size=0, ttl=None):
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+
+            if self.max_bytes is not None and size > self.max_bytes:
+                return value
+
+            expires = None if ttl is None else time() + ttl
+            self.entries[key] = (value, size, expires)
+            self.bytes += size
+            while len(self.entries) > self.max_entries or (
+                self.max_bytes is not None and self.bytes > self.max_bytes
+            ):
+                _, (_, evicted_size, _) = self.entries.popitem(last=False)
+                self.bytes -= evicted_size
+                self.evictions += 1
+        return value
+
+    def delete(self, key):
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+    def stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'entries': len(self.entries),
+            'bytes': self.bytes,
+        }
+
+
+class FieldCache:
+    """Cache of the values of a field: `Field(cache=FieldCache(ttl=60))`
+
+    Values are cached per node, field and instance (by its `pk` or `id`) for
+    each combination of parameters and, if `scope` is given, of the result
+    of `scope(ctx)`, like `lambda request: request.user.pk`.
+
+    The `backend` is an `LRUCache` of `max_entries` instances by default, but
+    it can be anything with `get(key)`, `set(key, value, ttl=)` and
+    `delete(key)`, like `carbon14.django.DjangoCacheBackend`.
+    """
+
+    def __init__(self, ttl=None, backend=None, scope=None, max_entries=1024):
+        self.ttl = ttl
+        self.backend = LRUCache(max_entries) if backend is None else backend
+        self.scope = scope
+
+    def key(self, node_name, field_name, pk):
+        return f'carbon14:{node_name}:{field_name}:{pk}'
+
+    def resolve(self, field, node, instance, kwargs):
+        """Cached value of `field` for `instance`, solving it if missing
+
+        Each variant (parameters and scope) is stored under its own key,
+        that includes the generation of the instance, changed to invalidate
+        all of them at once. Instances without `pk` or `id` are never cached.
+        """
+        pk = pk_of(instance)
+        if pk is None:
+            return field.solve(node, instance, kwargs)
+        key = self.variant_key(node, field, pk, kwargs)
+        cached = self.backend.get(key)
+        if cached is not None:
+            return cached[0]
+
+        value = field.solve(node, instance, kwargs)
+        if isawaitable(value):
+            return self.store_awaited(key, value)
+        self.backend.set(key, (value,), ttl=self.ttl)
+        return value
+
+    def variant_key(self, node, field, pk, kwargs):
+        generation_key = self.key(node.Meta.name, field.name, pk)
+        generation = self.backend.get(generation_key)
+        if generation is None:
+            generation = uuid4().hex
+            self.backend.set(generation_key, generation)
+        variant = repr((
+            sorted(kwargs.items()),
+            self.scope and self.scope(node.ctx),
+        ))
+        digest = sha256(variant.encode()).hexdigest()[:32]
+        return f'{generation_key}:{generation}:{digest}'
+
+    async def store_awaited(self, key, awaitable):
+        """Value of the `async def` resolvers, stored once awaited"""
+        value = await awaitable
+        self.backend.set(key, (value,), ttl=self.ttl)
+        return value
+
+    def invalidate(self, node_name, field_name, pk):
+        self.backend.delete(self.key(node_name, field_name, pk))
@@ -0,0 +1,70 @@
+"""Specialized serializers generated for each field selection.
+
+`Node.serialize` interprets the selection for every item it serializes. When a
+node sets `Meta.compile_serializers = True` the selection is translated once
+to a Python function where the plain fields become direct key or attribute
+accesses and only the custom resolvers are called.
+"""
+from functools import lru_cache
+
+
+def serializer_for(selection):
+    """Specialized serializer of `selection`: `f(node, item, selection)`"""
+    try:
+        return selection.serializer
+    except AttributeError:
+        selection.serializer = compile_serializer(shape_of(selection))
+        return selection.serializer
+
+
+def shape_of(selection):
+    return tuple(
+        (plan.name, plan.field.is_plain, plan.node is not None)
+        for plan in selection
+    )
+
+
+@lru_cache(maxsize=1024)
+def compile_serializer(shape):
+    namespace = {'related': related}
+    exec(generate(shape), namespace)
+    return namespace['serialize']
+
+
+def generate(shape):
+    """Python source of the serializer for the selection `shape`"""
+    source = ['def serialize(node, item, selection):']
+    if shape:
+        plans = ''.join(f'p{i}, ' for i in range(len(shape)))
+        source.append(f'    {plans}= selection')
+
+    if any(plain for _, plain, _ in shape):
+        from_dict = dict_literal(shape, 'item.get({name!r})')
+        from_object = dict_literal(shape, 'getattr(item, {name!r}, None)')
+        source.extend([
+            '    if isinstance(item, dict):',
+            '        return ' + from_dict,
+            '    return ' + from_object,
+        ])
+    else:
+        source.append('    return ' + dict_literal(shape, None))
+    return '\n'.join(source)
+
+
+def dict_literal(shape, access):
+    entries = []
+    for i, (name, plain, is_related) in enumerate(shape):
+        if plain:
+            value = access.format(name=name)
+        else:
+            value = f'p{i}.field.resolve(node, item, p{i}.kwargs)'
+        if is_related:
+            value = f'related(node, {value}, p{i})'
+        entries.append(f'{name!r}: {value}')
+    return '{' + ', '.join(entries) + '}'
+
+
+def related(node, value, plan):
+    if value is not None:
+        value = node.serialize_related_field(value, plan)
+    return value
@@ -0,0 +1,83 @@
+"""Static cost analysis of compiled queries.
+
+The cost is estimated from the plan alone, before solving anything:
+
+- `depth`: levels of nested nodes.
+- `fan_out`: the biggest number of items expected per parent item.
+- `rows`: the number of items expected to be serialized.
+
+The number of items of a collection is the `limit` or the amount of `ids`
+passed as parameters or else the `Meta.estimated_rows` of its node. Nodes can
+give the number of items per parent of their fields in `Meta.fan_out`, by
+default fields declared with `many=False` have 1 and the rest are considered
+collections.
+"""
+from typing import NamedTuple, Optional
+
+from .errors import QueryTooExpensive
+
+
+class Cost(NamedTuple):
+    depth: int
+    fan_out: int
+    rows: int
+
+
+class Budget(NamedTuple):
+    """Maximum `Cost` of the queries that are allowed to be executed"""
+    max_depth: Optional[int] = None
+    max_fan_out: Optional[int] = None
+    max_rows: Optional[int] = None
+
+    def check(self, query):
+        cost = analyze(query)
+        for measure, budget in zip(Cost._fields, self):
+            value = getattr(cost, measure)
+            if budget is not None and value > budget:
+                raise QueryTooExpensive(measure, value, budget)
+        return cost
+
+
+def analyze(query):
+    """`Cost` of the compiled root `query`"""
+    depth = fan_out = rows = 0
+    for plan in query:
+        items = limit(plan.node.Meta.estimated_rows, plan.kwargs)
+        level = selection_cost(plan.node, plan.fields, items)
+        depth = max(depth, level.depth)
+        fan_out = max(fan_out, level.fan_out)
+        rows += level.rows
+    return Cost(depth, fan_out, rows)
+
+
+def selection_cost(node, selection, items):
+    """`Cost` of serializing `items` of `node` with `selection`"""
+    depth, fan_out, rows = 1, 0, items
+    for plan in selection:
+        if plan.node is None or not plan.fields:
+            continue
+        per_parent = items_per_parent(node, plan)
+        level = selection_cost(plan.node, plan.fields, items * per_parent)
+        depth = max(depth, level.depth + 1)
+        fan_out = max(fan_out, per_parent, level.fan_out)
+        rows += level.rows
+    return Cost(depth, fan_out, rows)
+
+
+def items_per_parent(node, plan):
+    items = node.Meta.fan_out.get(plan.name)
+    if items is None:
+        if plan.field.many is False:
+            return 1
+        items = plan.node.Meta.estimated_rows
+    return limit(items, plan.kwargs)
+
+
+def limit(items, kwargs):
+    max_items = kwargs.get('limit')
+    if isinstance(max_items, int) and max_items > 0:
+        items = min(items, max_items)
+    ids = kwargs.get('ids')
+    if isinstance(ids, (list, tuple)):
+        items = min(items, len(ids))
+    return items
@@ -1,94 +1,397 @@
 from __future__ import annotations
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from contextlib import ExitStack, nullcontext
+from functools import partial, reduce
+from hashlib import sha256
+from operator import or_
+from typing import NamedTuple, Mapping
+from uuid import uuid4
 
+from asgiref.sync import sync_to_async
 from django import forms
-from django.db.models import QuerySet, Prefetch
-from django.http import HttpResponse
+from django.core.cache import caches
+from django.core.exceptions import FieldDoesNotExist
+from django.db import DEFAULT_DB_ALIAS, transaction
+from django.db.models import QuerySet, Prefetch, Q, F, Window
+from django.db.models.functions import RowNumber
+from django.db.models.query_utils import DeferredAttribute
+from django.db.models.signals import post_save, post_delete
+from django.http import HttpResponse, HttpResponseNotModified, \
+    StreamingHttpResponse
 from django.template import Template, RequestContext
 from django.core.exceptions import ValidationError
+from django.utils.http import parse_etags, quote_etag
 
 from rest_framework.views import APIView
 
-from .graphql import parse
-from .errors import Carbon14Error
+from .errors import Carbon14Error, AdHocQueryNotAllowed, InvalidCursor, \
+    UnknownQuery
 from . import neonode
 from . import json
+from .plan import bind_variables, query_text, nodes_in, value_text
+from .sql import SQLAudit
+from .utils import import_string, get_first_of
+
+
+class Hints(NamedTuple):
+    """What the queryset of a node needs to solve a field efficiently"""
+    prefetch_related: tuple = ()
+    select_related: tuple = ()
+    annotate: Mapping = {}
+
+    @classmethod
+    def of(cls, prefetch_related=None, select_related=None, annotate=None):
+        return cls(
+            as_tuple(prefetch_related),
+            as_tuple(select_related),
+            dict(annotate or {}),
+        )
+
+    def __add__(self, other):
+        return Hints(
+            self.prefetch_related + other.prefetch_related,
+            self.select_related + other.select_related,
+            {**self.annotate, **other.annotate},
+        )
+
+
+NO_HINTS = Hints()
 
 
 class Field(neonode.Field):
+    # is the field a column of the model of its node? (set by the node)
+    is_model_column = False
+
+    def __init__(
+        self, *args, columns=None, prefetch_related=None,
+        select_related=None, annotate=None, **kwargs,
+    ):
+        super().__init__(*args, **kwargs)
+        if isinstance(columns, str):
+            columns = (columns,)
+        # model fields used by the resolver, `None` if they are unknown
+        self.columns = columns
+        # lookups and annotations the resolver uses
+        self.hints = Hints.of(prefetch_related, select_related, annotate)
+
     def resolve(self, node: Node, instance, kwargs):
         value = super().resolve(node, instance, kwargs)
+        return all_values(value)
 
-        all_values = getattr(value, 'all', None)
-        if all_values:
-            value = all_values()
+    def get_models(self, model):
+        """Other models read to solve this field for items of `model`"""
+        return lookup_models(model, self.name)
 
-        return value
+    def resolve_batch(self, node: Node, instances, kwargs):
+        values = super().resolve_batch(node, instances, kwargs)
+        if self.batched:
+            values = [all_values(value) for value in values]
+        return values
 
     def optimize(self, source, *args, **kwargs):
         return source
 
+    def get_columns(self, model, plan, node=None, joined=True):
+        """Model fields needed to solve this field, `None` if unknown
+
+        Without declared `columns` only the fields solved by the default
+        resolver from a column of the `model` are known.
+        """
+        if self.columns is not None:
+            return self.columns
+        if self.has_default_resolver and is_column(model, self.name):
+            return (self.name,)
+        return None
+
+    def get_values(self, model, plan, node=None, nested=False):
+        """Names to get from `values()` to solve this field from the rows,
+        `None` if it needs the model instances
+
+        `nested` is for the fields of the related items of `A` fields.
+        """
+        if (
+            self.has_default_resolver and
+            self.cache is None and
+            not self.batched and
+            plan.node is None and
+            is_stored_value(model, self.name)
+        ):
+            return [self.name]
+        return None
+
+    def annotate(self, source, plan):
+        """`source` with the annotations needed to solve this field"""
+        return source
+
+    @property
+    def is_plain(self):
+        """Columns with the default resolver are read as attributes, other
+        values (like related managers) need `resolve`
+        """
+        return (
+            self.is_model_column and
+            self.node_type is None and
+            type(self).resolve is Field.resolve and
+            self.has_default_resolver and
+            self.cache is None
+        )
+
+    @property
+    def has_default_resolver(self):
+        """Is the value just the attribute `name` of the instances?"""
+        return (
+            type(self).resolver is neonode.Field.resolver and
+            'resolver' not in vars(self)
+        )
+
 
 class A(Field):
+    many = False
+
     def __init__(self, node_type=None, select=None):
         super().__init__(node_type)
         if isinstance(select, str):
             select = (select,)
         self.select = select
 
-    def optimize(self, source, prefix, data, node=None):
+    def optimize(self, source, prefix, plan, node=None):
         for select in self.select or (self.name,):
-            if prefix:
-                source = source.prefetch_related(prefix + select)
-                if node:
-                    source = node.query_optimization(
-                        source,
-                        data['fields'],
-                        prefix=prefix + select + '__',
-                    )
-            else:
-                source = source.select_related(select)
+            source = source.select_related(prefix + select)
+            if node:
+                source = node.query_optimization(
+                    source,
+                    plan.fields,
+                    prefix=prefix + select + '__',
+                )
         return source
 
+    def get_values(self, model, plan, node=None, nested=False):
+        """The columns of the related item, when they are plain columns"""
+        if not (
+            not nested and
+            node and plan.fields and
+            self.select in (None, (self.name,)) and
+            self.has_default_resolver and
+            self.cache is None and
+            not self.batched and
+            is_column(model, self.name)
+        ):
+            return None
+        values = node.get_values(plan.fields, nested=True)
+        if values is None:
+            return None
+        return [f'{self.name}__{name}' for name in values]
+
+    def get_columns(self, model, plan, node=None, joined=True):
+        """The foreign keys and, when `joined` by `select_related`, the
+        columns needed from the related model
+        """
+        columns = []
+        for select in self.select or (self.name,):
+            columns.append(select.split('__')[0])
+            if joined and node and '__' not in select:
+                nested = node.get_columns(plan.fields, joined=False)
+                if nested is not None:
+                    pk = node.Meta.source.model._meta.pk.name
+                    columns.append(f'{select}__{pk}')
+                    columns.extend(f'{select}__{c}' for c in nested)
+        return columns
+
 
 class Many(Field):
+    many = True
+
     def __init__(self, node_type=None, prefetch=None):
         super().__init__(node_type)
         if isinstance(prefetch, str):
             prefetch = (prefetch,)
         self.prefetch = prefetch
 
-    def optimize(self, source, prefix, data, node=None):
+    def optimize(self, source, prefix, plan, node=None):
         if self.prefetch:
-            for pretech in self.prefetch:
-                source = source.prefetch_related(prefix + self.name)
+            for lookup in self.prefetch:
+                source = source.prefetch_related(prefixed(prefix, lookup))
         elif node:
-            source = source.prefetch_related(
-                Prefetch(
-                    prefix + self.name,
-                    queryset=node.filter(
-                        node.Meta.source,
-                        **data['kwargs']
-                    )
+            queryset = node.filter(node.get_source(), **plan.kwargs)
+            queryset = node.query_optimization(queryset, plan.fields)
+            queryset = node.annotate(queryset, plan.fields)
+            if is_cursor_paginated(plan.kwargs):
+                queryset = node.seek(queryset, plan.kwargs)
+            related = relation_columns(queryset.model, self.name)
+            if related is not None:
+                queryset = node.prune_columns(
+                    queryset,
+                    plan.fields,
+                    related + node.get_cursor_columns(plan.kwargs),
                 )
-            )
-            source = node.query_optimization(
-                source,
-                data['fields'],
-                prefix=prefix + self.name + '__',
+            if related:
+                queryset = slice_partitions(queryset, related, plan.kwargs)
+            source = source.prefetch_related(
+                ManyPrefetch(prefix + self.name, queryset=queryset)
             )
         return source
 
+    @property
+    def alias(self):
+        return f'carbon14_{self.name}'
+
+    def resolver(self, node, instance, **kwargs):
+        # the items prefetched apart from the relation (`unique_prefetches`)
+        items = get_first_of(instance, self.alias)
+        if items is None:
+            return super().resolver(node, instance, **kwargs)
+        return items
+
+    def get_columns(self, model, plan, node=None, joined=True):
+        # the related items are matched by the pk, always loaded
+        return ()
+
+
+class Annotation(Field):
+    """Field solved by the database annotating the queryset of its node
+    with `expression`, like `Count('books')`, `Sum('books__n_pages')` or
+    `Exists(...)`, so it takes one query for all the items
+
+    The items that come from a queryset without the annotation, like the
+    ones of `A` fields, are annotated one by one.
+    """
+
+    def __init__(self, expression, node_type=None, **kwargs):
+        super().__init__(node_type, **kwargs)
+        self.expression = expression
+
+    @property
+    def alias(self):
+        return f'carbon14_{self.name}'
+
+    def resolver(self, node, instance, **kwargs):
+        if isinstance(instance, dict):
+            return instance.get(self.alias)
+        try:
+            return getattr(instance, self.alias)
+        except AttributeError:
+            manager = type(instance)._default_manager
+            return manager.db_manager(instance._state.db).filter(
+                pk=instance.pk,
+            ).annotate(**{
+                self.alias: self.expression,
+            }).values_list(self.alias, flat=True).get()
+
+    def annotate(self, source, plan):
+        return source.annotate(**{self.alias: self.expression})
+
+    def get_models(self, model):
+        return expression_models(model, self.expression)
+
+    def get_columns(self, model, plan, node=None, joined=True):
+        return ()
+
+    def get_values(self, model, plan, node=None, nested=False):
+        return None if nested else [self.alias]
+
 
 class Node(neonode.Node):
 
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        source = cls.Meta.source
+        if isinstance(source, QuerySet):
+            for name, field in cls._fields.items():
+                field.is_model_column = is_column(source.model, name)
+        # Invalidate the cached fields when their instances change
+        if isinstance(source, QuerySet) and any(
+            field.cache is not None for field in cls._fields.values()
+        ):
+            receiver = partial(invalidate_cached_fields, cls)
+            uid = f'carbon14:{cls.__module__}.{cls.__qualname__}'
+            for signal in (post_save, post_delete):
+                signal.connect(
+                    receiver,
+                    sender=source.model,
+                    weak=False,
+                    dispatch_uid=uid,
+                )
+
     class Meta(neonode.Node.Meta):
         is_public = False
         field_class = Field
+        # fields the items are ordered by when paginated with cursors, with
+        # `-` for the descending ones, the pk is added to make it unique
+        cursor_ordering = ('pk',)
+        # optimization hints of the fields, {field_name: lookups to prefetch}
+        # or {field_name: {'prefetch_related': ..., 'select_related': ...,
+        # 'annotate': {...}}}
+        optimize = {}
+        # rows fetched at a time for the items of the roots when streaming
+        chunk_size = 2000
 
     def query(self, kwargs, fields, source=None):
+        data = super().query(kwargs, fields, source)
+        if isinstance(data, dict) or self.is_streamed(source):
+            return data
+        return list(data)
+
+    def is_streamed(self, source=None):
+        """Are the items of `source` encoded as they are serialized? Only
+        for the roots (`source` is `None`) of streaming executions
+        """
+        return source is None and self.execution.streaming
+
+    async def afetch(self, kwargs, fields, source=None):
+        """`fetch` in a thread, as the ORM can't be used in the event loop
+
+        The resolvers run in the loop, so they get the related items that
+        were joined or prefetched but can't make queries themselves.
+        """
+        return await sync_to_async(
+            lambda: neonode.as_list(self.fetch(kwargs, fields, source))
+        )()
+
+    def get_source(self):
+        """`Meta.source` read from the database of the execution"""
+        using = self.execution.using
+        source = self.Meta.source
+        return source.all() if using is None else source.using(using)
+
+    def fetch(self, kwargs, fields, source=None):
+        """Items to serialize, the ones of `Meta.source` fetched once per
+        execution for the same parameters and fields
+        """
+        fetched = self.execution.cache
+        if source is not None or fetched is None or self.is_streamed():
+            return self.fetch_items(kwargs, fields, source)
+        key = (type(self), value_text(kwargs), query_text(fields))
+        items = fetched.get(key)
+        if items is None:
+            items = fetched[key] = neonode.as_list(
+                self.fetch_items(kwargs, fields)
+            )
+        return items
+
+    def fetch_items(self, kwargs, fields, source=None):
+        values = None
+        streamed = self.is_streamed(source)
         if source is None:
-            source = self.query_optimization(self.Meta.source, fields)
-            source = self.filter(source, **kwargs)
+            source = self.query_optimization(self.get_source(), fields)
+            source = self.prune_columns(
+                source, fields, self.get_cursor_columns(kwargs),
+            )
+            source = self.filtered(source, kwargs, fields)
+            source = self.annotate(source, fields)
+            if not is_cursor_paginated(kwargs):
+                values = self.get_values(fields)
+                if values is not None:
+                    # serialize the rows instead of model instances
+                    source = source.values(*values)
+
+        if is_cursor_paginated(kwargs):
+            # the prefetched sources were already seeked by `Many.optimize`
+            if isinstance(source, QuerySet) and source._result_cache is None:
+                source = self.seek(source, kwargs)
+            return self.page(source, kwargs)
+
+        if is_sliced_partition(source):
+            return source
 
         limit = kwargs.get('limit')
         offset = kwargs.get('offset')
@@ -98,19 +401,137 @@ class Node(neonode.Node):
         if limit:
             source = source[:limit]
 
-        return [self.serialize(item, fields) for item in source]
+        if streamed:
+            # without keeping all the rows in the result cache
+            source = source.iterator(chunk_size=self.Meta.chunk_size)
+
+        if values and any('__' in name for name in values):
+            source = map(nest_values, source)
+        return source
 
     def query_optimization(self, source: QuerySet, fields, prefix=''):
-        self.check_if_requesting_missing_fields(fields)
-        for field_name, data in fields.items():
-            source = self._fields[field_name].optimize(
+        """`source` joining or prefetching what is needed to solve `fields`
+
+        `prefix` is the path to the items of this node from the ones of
+        `source`, through the `select_related` of `A` fields.
+        """
+        for plan in fields:
+            hints = self.get_hints(plan.field)
+            if hints.prefetch_related:
+                source = source.prefetch_related(*(
+                    prefixed(prefix, lookup)
+                    for lookup in hints.prefetch_related
+                ))
+            if hints.select_related:
+                source = source.select_related(*(
+                    prefix + lookup for lookup in hints.select_related
+                ))
+            source = plan.field.optimize(
                 source,
                 prefix,
-                data,
-                node=self.get_node_for(field_name),
+                plan,
+                node=plan.node and self.execution.node(plan.node),
+            )
+        if not prefix:
+            source = unique_prefetches(source)
+        return source
+
+    @classmethod
+    def get_hints(cls, field):
+        """`Hints` of `field`, declared in it and in `Meta.optimize`"""
+        hints = cls.Meta.optimize.get(field.name)
+        if hints is None:
+            return field.hints
+        if not isinstance(hints, dict):
+            hints = {'prefetch_related': hints}
+        return field.hints + Hints.of(**hints)
+
+    @classmethod
+    def get_models(cls, field):
+        """Models other than the one of `Meta.source` read to solve `field`,
+        as far as its relation, expression and hints tell
+        """
+        model = cls.Meta.source.model
+        hints = cls.get_hints(field)
+        models = set(field.get_models(model))
+        for lookup in hints.prefetch_related:
+            if getattr(lookup, 'queryset', None) is not None:
+                models.add(lookup.queryset.model)
+            models.update(lookup_models(model, lookup_path(lookup)))
+        for lookup in hints.select_related:
+            models.update(lookup_models(model, lookup))
+        for expression in hints.annotate.values():
+            models.update(expression_models(model, expression))
+        return models
+
+    def get_columns(self, fields, joined=True):
+        """Model fields needed to serialize `fields`, `None` if unknown
+
+        With `joined` the items of `A` fields are loaded with
+        `select_related`, so the columns they need are included.
+        """
+        model = self.Meta.source.model
+        columns = set()
+        for plan in fields:
+            needed = plan.field.get_columns(
+                model,
+                plan,
+                node=plan.node and self.execution.node(plan.node),
+                joined=joined,
+            )
+            if needed is None:
+                return None
+            columns.update(needed)
+            # the foreign keys of the relations used by the resolver
+            hints = self.get_hints(plan.field)
+            for lookup in hints.prefetch_related + hints.select_related:
+                name = lookup_path(lookup).split('__')[0]
+                if is_column(model, name):
+                    columns.add(name)
+        return columns
+
+    def get_values(self, fields, nested=False):
+        """Names to get from `values()` to serialize `fields` from the rows
+        (with the pk), `None` if the model instances are needed
+
+        Only plain columns and annotations qualify and, unless `nested` in
+        the row of another node, `A` fields with plain columns of the
+        related item.
+        """
+        model = self.Meta.source.model
+        names = [model._meta.pk.name]
+        for plan in fields:
+            if self.get_hints(plan.field) != NO_HINTS:
+                return None
+            values = plan.field.get_values(
+                model,
+                plan,
+                node=plan.node and self.execution.node(plan.node),
+                nested=nested,
             )
+            if values is None:
+                return None
+            names.extend(values)
+        return list(dict.fromkeys(names))
+
+    def annotate(self, source, fields):
+        """`source` with the annotations of the fields in `fields`"""
+        for plan in fields:
+            annotations = self.get_hints(plan.field).annotate
+            if annotations:
+                source = source.annotate(**annotations)
+            source = plan.field.annotate(source, plan)
         return source
 
+    def prune_columns(self, source, fields, extra=(), joined=True):
+        """Load only the columns of `source` needed for `fields` and the
+        `extra` ones, when all of them are known
+        """
+        columns = self.get_columns(fields, joined)
+        if columns is None:
+            return source
+        return source.only('pk', *columns, *extra)
+
     def filter(self, _source: QuerySet, ids=None, **kwargs) -> QuerySet:
         if not self.Meta.is_public and not self.ctx.user.is_authenticated:
             _source = _source.none()
@@ -123,6 +544,456 @@ class Node(neonode.Node):
     def is_collection(self, value):
         return isinstance(value, QuerySet) or super().is_collection(value)
 
+    def get_cursor_ordering(self):
+        """`Meta.cursor_ordering` with the pk, as (field, descending) pairs"""
+        ordering = [
+            (name.lstrip('-'), name.startswith('-'))
+            for name in self.Meta.cursor_ordering
+        ]
+        if not any(name in ('pk', 'id') for name, _ in ordering):
+            ordering.append(('pk', False))
+        return ordering
+
+    def get_cursor_columns(self, kwargs):
+        """Columns needed for the cursors of the page asked by `kwargs`"""
+        if not is_cursor_paginated(kwargs):
+            return []
+        return [name.split('__')[0] for name, _ in self.get_cursor_ordering()]
+
+    def seek(self, source: QuerySet, kwargs) -> QuerySet:
+        """Order `source` by the cursor ordering and keep the items after
+        the `after` cursor or, in reverse order, the ones before `before`
+        """
+        ordering = self.get_cursor_ordering()
+        for name, before in (('after', False), ('before', True)):
+            cursor = kwargs.get(name)
+            if cursor is not None:
+                values = decode_cursor(cursor, len(ordering))
+                source = source.filter(keyset(ordering, values, before))
+        backwards = is_backwards(kwargs)
+        return source.order_by(*(
+            ('-' if descending != backwards else '') + name
+            for name, descending in ordering
+        ))
+
+    def page(self, source, kwargs):
+        """`Page` of at most `limit` items of the seeked `source`"""
+        limit = kwargs.get('limit')
+        if limit:
+            items = list(source[:limit + 1])
+            more = len(items) > limit
+            items = items[:limit]
+        else:
+            items = list(source)
+            more = False
+        after = kwargs.get('after')
+        before = kwargs.get('before')
+        if is_backwards(kwargs):
+            items.reverse()
+            has_next, has_previous = before is not None, more
+        else:
+            has_next = more or before is not None
+            has_previous = after is not None
+        return neonode.Page(items, {
+            'start_cursor': self.cursor_of(items[0]) if items else None,
+            'end_cursor': self.cursor_of(items[-1]) if items else None,
+            'has_next': has_next,
+            'has_previous': has_previous,
+        })
+
+    def cursor_of(self, item):
+        return encode_cursor([
+            reduce(getattr, name.split('__'), item)
+            for name, _ in self.get_cursor_ordering()
+        ])
+
+
+def nest_values(row):
+    """Row of `values()` with the `related__name` keys in nested dicts, that
+    are `None` when the related item doesn't exist
+    """
+    related = {}
+    for key in [key for key in row if '__' in key]:
+        name, _, field = key.partition('__')
+        related.setdefault(name, {})[field] = row.pop(key)
+    for name, item in related.items():
+        exists = any(value is not None for value in item.values())
+        row[name] = item if exists else None
+    return row
+
+
+ROW_NUMBER = 'carbon14_row_number'
+
+
+def slice_partitions(queryset, partition, kwargs):
+    """Keep in `queryset` only the rows asked by `limit` and `offset` for
+    each value of the `partition` columns (each parent of the items)
+
+    The rows are numbered by the database with `ROW_NUMBER() OVER
+    (PARTITION BY ...)` in the order of the queryset. Cursor pages get one
+    more row, to know if there is a next page.
+    """
+    limit = kwargs.get('limit')
+    offset = kwargs.get('offset') or 0
+    if is_cursor_paginated(kwargs):
+        limit = limit and limit + 1
+        offset = 0
+    if not (limit or offset):
+        return queryset
+
+    ordering = (
+        queryset.query.order_by or queryset.model._meta.ordering or ('pk',)
+    )
+    queryset = queryset.annotate(**{ROW_NUMBER: Window(
+        RowNumber(),
+        partition_by=[F(name) for name in partition],
+        order_by=[order_expression(order) for order in ordering],
+    )})
+    queryset = queryset.filter(**{f'{ROW_NUMBER}__gt': offset})
+    if limit:
+        queryset = queryset.filter(**{f'{ROW_NUMBER}__lte': offset + limit})
+    return queryset
+
+
+def order_expression(order):
+    """Expression of an `order_by()` argument"""
+    if not isinstance(order, str):
+        return order
+    if order.startswith('-'):
+        return F(order[1:]).desc()
+    return F(order).asc()
+
+
+def is_sliced_partition(source):
+    """Was `source` prefetched with its `limit` and `offset` applied?"""
+    if isinstance(source, QuerySet):
+        return ROW_NUMBER in source.query.annotations
+    # items prefetched to an attribute, see `unique_prefetches`
+    return (
+        isinstance(source, list) and
+        bool(source) and
+        hasattr(source[0], ROW_NUMBER)
+    )
+
+
+def is_stored_value(model, name):
+    """Is the attribute `name` of the instances of `model` the value of its
+    column as `values()` returns it? (not for files or custom descriptors)
+    """
+    return (
+        is_column(model, name) and
+        type(getattr(model, name, None)) is DeferredAttribute
+    )
+
+
+def is_column(model, name):
+    """Is `name` a field of `model` stored in its table?"""
+    try:
+        field = model._meta.get_field(name)
+    except FieldDoesNotExist:
+        return False
+    return field.concrete and not field.many_to_many
+
+
+def relation_columns(model, accessor):
+    """Fields of `model` needed to prefetch its instances through the
+    related manager `accessor` of another model, `None` if unknown
+    """
+    columns = None
+    for field in model._meta.get_fields():
+        if not field.is_relation:
+            continue
+        remote = field.remote_field
+        if field.concrete:
+            matches = remote.get_accessor_name() == accessor
+        else:
+            matches = field.many_to_many and remote.name == accessor
+        if matches:
+            columns = columns or []
+            if not field.many_to_many:
+                columns.append(field.name)
+    return columns
+
+
+def lookup_models(model, lookup):
+    """Models joined following `lookup`, like `'books__author'`, from the
+    ones of `model`
+    """
+    models = []
+    for name in lookup.split('__'):
+        try:
+            field = model._meta.get_field(name)
+        except FieldDoesNotExist:
+            break
+        if not field.is_relation or field.related_model is None:
+            break
+        model = field.related_model
+        models.append(model)
+    return models
+
+
+def expression_models(model, expression):
+    """Models read by `expression` (like `Count('books')` or `Exists(...)`)
+    annotated on the items of `model`
+    """
+    models = []
+    if isinstance(expression, F):
+        models.extend(lookup_models(model, expression.name))
+    query = getattr(expression, 'query', None)
+    if getattr(query, 'model', None) is not None:
+        # subqueries
+        models.append(query.model)
+    if hasattr(expression, 'get_source_expressions'):
+        for source in expression.get_source_expressions():
+            models.extend(expression_models(model, source))
+    return models
+
+
+def is_cursor_paginated(kwargs):
+    return 'after' in kwargs or 'before' in kwargs
+
+
+def is_backwards(kwargs):
+    """Is the page the one before the `before` cursor?"""
+    return 'before' in kwargs and 'after' not in kwargs
+
+
+def encode_cursor(values):
+    return urlsafe_b64encode(json.dumps(values).encode()).decode()
+
+
+def decode_cursor(cursor, n_values):
+    try:
+        values = json.loads(urlsafe_b64decode(cursor.encode()))
+    except (ValueError, TypeError, AttributeError):
+        raise InvalidCursor(cursor)
+    if not isinstance(values, list) or len(values) != n_values:
+        raise InvalidCursor(cursor)
+    return values
+
+
+def keyset(ordering, values, backwards=False):
+    """Condition for the rows coming after `values` in the `ordering`
+
+    (a, -b, pk) after (1, 2, 3) is: a > 1 or a = 1 and b < 2 or a = 1 and
+    b = 2 and pk > 3. With `backwards` the rows coming before them.
+    """
+    conditions = []
+    for i, (name, descending) in enumerate(ordering):
+        lookup = 'lt' if descending != backwards else 'gt'
+        condition = Q(**{f'{name}__{lookup}': values[i]})
+        for previous, value in zip(ordering[:i], values):
+            condition &= Q(**{previous[0]: value})
+        conditions.append(condition)
+    return reduce(or_, conditions)
+
+
+def invalidate_cached_fields(node, sender, instance, **kwargs):
+    for field in node._fields.values():
+        if field.cache is not None:
+            field.cache.invalidate(node.Meta.name, field.name, instance.pk)
+
+
+class DjangoCacheBackend:
+    """`carbon14.cache.FieldCache` backend using a Django cache"""
+
+    def __init__(self, alias='default'):
+        self.alias = alias
+
+    def get(self, key, default=None):
+        return caches[self.alias].get(key, default)
+
+    def set(self, key, value, ttl=None):
+        caches[self.alias].set(key, value, timeout=ttl)
+
+    def delete(self, key):
+        caches[self.alias].delete(key)
+
+
+class ResponseCache:
+    """Cache of the JSON answers of a view in the Django cache `alias`
+
+    The answers are keyed by the query (as compiled, with the values of its
+    parameters), the output format, the scope (shared when every node of
+    the query is public or else per user) and the versions of the models
+    the query reads, that change when their instances are saved or deleted.
+
+    The models read are the ones of the nodes and the ones the fields tell
+    with their relation, `Annotation` expression and optimization hints.
+    Resolvers reading other models should declare them in their hints, or
+    the answers can be stale until their `ttl` (in seconds) expires.
+    """
+
+    def __init__(self, alias='default', ttl=None):
+        self.alias = alias
+        self.ttl = ttl
+
+    @property
+    def cache(self):
+        return caches[self.alias]
+
+    def key(self, request, query, output):
+        nodes = nodes_in(query)
+        models = sorted(model._meta.label for model in query_models(query))
+        version_keys = [model_version_key(model) for model in models]
+        versions = self.get_versions(version_keys)
+        if all(getattr(node.Meta, 'is_public', False) for node in nodes):
+            scope = 'public'
+        else:
+            scope = f'user:{request.user.pk}'
+        text = '\n'.join([
+            scope,
+            output,
+            # the same names can be used by other node classes in other views
+            *sorted(f'{n.__module__}.{n.__qualname__}' for n in nodes),
+            query_text(query),
+            *(f'{key}={versions[key]}' for key in version_keys),
+        ])
+        return 'carbon14:response:' + sha256(text.encode()).hexdigest()
+
+    def get_versions(self, keys):
+        """{key: version} of the models, creating the ones missing (never
+        set or evicted), so no answer is valid again after it was removed
+        """
+        versions = self.cache.get_many(keys)
+        missing = [key for key in keys if key not in versions]
+        if missing:
+            for key in missing:
+                self.cache.add(key, uuid4().hex, timeout=None)
+            versions.update(self.cache.get_many(missing))
+        return versions
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, content):
+        self.cache.set(key, content, timeout=self.ttl)
+
+    def connect(self, nodes):
+        """Invalidate the answers when the instances of the models that
+        `nodes` can read are saved or deleted
+        """
+        models = set()
+        for node in nodes:
+            if isinstance(node, str):
+                node = import_string(node)
+            if isinstance(node.Meta.source, QuerySet):
+                models.add(node.Meta.source.model)
+                for field in node._fields.values():
+                    models.update(node.get_models(field))
+        receiver = partial(invalidate_responses, self.alias)
+        for model in models:
+            label = model._meta.label
+            for signal in (post_save, post_delete):
+                signal.connect(
+                    receiver,
+                    sender=model,
+                    weak=False,
+                    dispatch_uid=f'carbon14:responses:{self.alias}:{label}',
+                )
+
+
+def query_models(selection, node=None):
+    """Models read to solve `selection` of the `node` class"""
+    models = set()
+    for plan in selection:
+        if node is not None and plan.field is not None:
+            models.update(node.get_models(plan.field))
+        source = plan.node and plan.node.Meta.source
+        if isinstance(source, QuerySet):
+            models.add(source.model)
+            models.update(query_models(plan.fields, plan.node))
+    return models
+
+
+def model_version_key(label):
+    return f'carbon14:version:{label}'
+
+
+def invalidate_responses(alias, sender, **kwargs):
+    caches[alias].set(
+        model_version_key(sender._meta.label), uuid4().hex, timeout=None,
+    )
+
+
+def unique_prefetches(source):
+    """`source` prefetching each lookup once, the outer ones first
+
+    The relations that `Many` fields prefetch with their own parameters and
+    columns and that the lookups of the hints (for the resolvers) prefetch
+    or traverse too are prefetched twice: for the `Many` field to the
+    `Many.alias` attribute of the parents, so the resolvers get all the
+    items. Of the hints for the same relation, the one with a queryset is
+    kept.
+    """
+    hints = {}
+    many = {}
+    for lookup in source._prefetch_related_lookups:
+        if isinstance(lookup, ManyPrefetch):
+            many.setdefault(lookup.prefetch_to, lookup)
+            continue
+        path = getattr(lookup, 'prefetch_to', lookup)
+        if path not in hints or getattr(lookup, 'queryset', None) is not None:
+            hints[path] = lookup
+    if not hints and not many:
+        return source
+    traversed = {
+        path.rsplit('__', i)[0]
+        for path in hints
+        for i in range(path.count('__') + 1)
+    }
+    lookups = list(hints.values())
+    for path, lookup in many.items():
+        if path in traversed:
+            name = path.rpartition('__')[2]
+            lookup = Prefetch(
+                path, queryset=lookup.queryset, to_attr=f'carbon14_{name}',
+            )
+        lookups.append(lookup)
+    return source.prefetch_related(None).prefetch_related(*sorted(
+        lookups,
+        key=lambda lookup: getattr(lookup, 'prefetch_to', lookup).count('__'),
+    ))
+
+
+class ManyPrefetch(Prefetch):
+    """Prefetch of the items of a `Many` field"""
+
+
+def prefixed(prefix, lookup):
+    """`lookup` (a string or a `Prefetch`) from the items `prefix` leads to
+    """
+    if not isinstance(lookup, Prefetch):
+        return prefix + lookup
+    if not prefix:
+        return lookup
+    return type(lookup)(
+        prefix + lookup.prefetch_through,
+        queryset=lookup.queryset,
+        to_attr=lookup.to_attr,
+    )
+
+
+def lookup_path(lookup):
+    """Relations followed by `lookup`, a string or a `Prefetch`"""
+    return getattr(lookup, 'prefetch_through', lookup)
+
+
+def as_tuple(value):
+    if value is None:
+        return ()
+    if isinstance(value, (str, Prefetch)):
+        return (value,)
+    return tuple(value)
+
+
+def all_values(value):
+    """Items of related managers, other values as they are"""
+    get_all = getattr(value, 'all', None)
+    if get_all:
+        value = get_all()
+    return value
+
 
 class GrapQLForm(forms.Form):
     query = forms.CharField(widget=forms.Textarea)
@@ -132,6 +1003,48 @@ class GraphQLView(APIView):
 
     nodes = tuple()
 
+    # `carbon14.graphql.ParseCache` for the queries of this view, by default
+    # the one shared by all the views
+    parse_cache = None
+
+    # `carbon14.persisted.PersistedQueries` that can be executed with `?id=`
+    persisted_queries = None
+
+    # can queries that are not persisted be executed with `?query=`?
+    allow_ad_hoc_queries = True
+
+    # `carbon14.cost.Budget` of the queries allowed to be executed
+    budget = None
+
+    # stream the JSON answers, encoding the items as they are serialized
+    streaming = False
+
+    # `carbon14.tracing.Tracer` of the queries and the encoding of answers
+    tracer = None
+
+    # `carbon14.sql.QueryBudget` of the SQL queries executed per request
+    query_budget = None
+
+    # `ResponseCache` of the JSON answers of the queries without mutations
+    response_cache = None
+
+    # database alias the read-only queries are solved from, like a replica,
+    # the ones with mutations are solved in a transaction of the `primary`
+    replica = None
+    primary = DEFAULT_DB_ALIAS
+
+    @classmethod
+    def as_view(cls, **initkwargs):
+        persisted_queries = initkwargs.get(
+            'persisted_queries', cls.persisted_queries
+        )
+        if persisted_queries is not None:
+            persisted_queries.compile(initkwargs.get('nodes', cls.nodes))
+        response_cache = initkwargs.get('response_cache', cls.response_cache)
+        if response_cache is not None:
+            response_cache.connect(initkwargs.get('nodes', cls.nodes))
+        return super().as_view(**initkwargs)
+
     @property
     def template(self):
         return Template('''
@@ -164,10 +1077,40 @@ class GraphQLView(APIView):
         ''')
 
     def get(self, request):
-        query = request.GET.get('query') or ''
-        root_node = neonode.RootNode(self.nodes, ctx=request)
+        pure_json = 'text/html' not in request.META.get('HTTP_ACCEPT', '')
+        output = request.GET.get('output') or 'nested'
+        content = cache_key = None
         try:
-            data = root_node.query(parse(query))
+            query, cache = self.get_query(request)
+            variables = self.get_variables(request)
+            root_node = self.get_root_node(request, cache)
+            query = bind_variables(root_node.compile(query), variables)
+            if (
+                pure_json and
+                self.response_cache is not None and
+                not query.mutates
+            ):
+                cache_key = self.response_cache.key(request, query, output)
+                content = self.response_cache.get(cache_key)
+            if content is None:
+                execution = self.get_execution(
+                    root_node,
+                    output,
+                    streaming=(
+                        pure_json and
+                        self.streaming and
+                        root_node.is_read_only(query)
+                    ),
+                )
+                with ExitStack() as contexts:
+                    contexts.enter_context(self.audit(root_node, execution))
+                    contexts.enter_context(
+                        self.route(root_node, query, execution)
+                    )
+                    data = root_node.query(query, execution=execution)
+                    if execution.streaming:
+                        # the items are solved while the answer is sent
+                        contexts = contexts.pop_all()
         except Carbon14Error as e:
             data = {'details': str(e)}
             status = 400
@@ -177,19 +1120,185 @@ class GraphQLView(APIView):
         else:
             status = 200
 
-        pure_json = 'text/html' not in request.META.get('HTTP_ACCEPT')
-        indent = None if pure_json else 2
-        data = json.dumps(data, indent=indent)
-        if pure_json:
-            return HttpResponse(
-                data,
-                status=status,
+        if pure_json and self.streaming and status == 200 and content is None:
+            return StreamingHttpResponse(
+                self.stream(data, contexts),
                 content_type='application/json',
             )
+
+        if pure_json:
+            if content is None:
+                content = self.encode(data)
+                if cache_key is not None and status == 200:
+                    self.response_cache.set(cache_key, content)
+            return self.json_response(request, content, status)
         else:
+            data = self.encode(data, indent=2)
             form = GrapQLForm(data=request.GET)
             return HttpResponse(self.render(form=form, answer=data))
 
+    def stream(self, data, contexts):
+        """Chunks of the JSON of `data`, solved inside `contexts`"""
+        with contexts:
+            yield from json.iterdumps(data)
+
+    def json_response(self, request, content, status=200):
+        """Response with the JSON `content`, or `304 Not Modified` when the
+        client has it, as told by its `ETag`
+        """
+        if status != 200:
+            return HttpResponse(
+                content,
+                status=status,
+                content_type='application/json',
+            )
+        etag = quote_etag(sha256(content.encode()).hexdigest()[:32])
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+        if if_none_match:
+            etags = parse_etags(if_none_match)
+            if etag in etags or '*' in etags:
+                response = HttpResponseNotModified()
+                response['ETag'] = etag
+                return response
+        response = HttpResponse(content, content_type='application/json')
+        response['ETag'] = etag
+        return response
+
+    def post(self, request):
+        """Execute a batch of queries sharing the nodes and their caches
+
+        The body is a JSON array of `{"query": ..., "variables": {...}}` (or
+        `{"id": ...}` for persisted queries) and the answer is an array with
+        `{"data": ...}` or `{"details": error}` for each query.
+        """
+        batch = request.data
+        try:
+            if not isinstance(batch, list):
+                raise Carbon14Error('Expected a JSON array of queries.')
+            root_node = self.get_root_node(request, self.parse_cache)
+            execution = self.get_execution(
+                root_node, request.GET.get('output') or 'nested',
+            )
+        except Carbon14Error as e:
+            return HttpResponse(
+                self.encode({'details': str(e)}),
+                status=400,
+                content_type='application/json',
+            )
+
+        try:
+            with self.audit(root_node, execution):
+                results = [
+                    self.execute(request, params, root_node, execution)
+                    for params in batch
+                ]
+        except Carbon14Error as e:
+            return HttpResponse(
+                self.encode({'details': str(e)}),
+                status=400,
+                content_type='application/json',
+            )
+        return HttpResponse(
+            self.encode(results),
+            content_type='application/json',
+        )
+
+    def audit(self, root_node, execution=None):
+        """Context where the SQL queries of `root_node` (and `execution`)
+        are checked against the `query_budget`, if any
+        """
+        if self.query_budget is None:
+            return nullcontext()
+        audit = SQLAudit(self.query_budget, tracer=root_node.tracer)
+        root_node.tracer = audit
+        if execution is not None:
+            execution.tracer = audit
+        return audit.capture()
+
+    def execute(self, request, params, root_node, execution):
+        """Result of one query of a batch, solved in the shared `execution`"""
+        try:
+            if not isinstance(params, dict):
+                raise Carbon14Error('Queries should be JSON objects.')
+            query, cache = self.get_query(request, params)
+            variables = self.get_variables(request, params)
+            root_node.cache = cache
+            query = bind_variables(root_node.compile(query), variables)
+            with self.route(root_node, query, execution):
+                data = root_node.query(query, execution=execution)
+        except Carbon14Error as e:
+            return {'details': str(e)}
+        except ValidationError as e:
+            return {'details': dict(e)}
+        return {'data': data}
+
+    def route(self, root_node, query, execution):
+        """Context where `query` is solved in `execution`
+
+        Read-only queries read from the `replica` database, if any, and the
+        ones with mutations are solved in a transaction of the `primary`.
+        """
+        if root_node.is_read_only(query):
+            execution.using = self.replica
+            return nullcontext()
+        execution.using = self.primary
+        return transaction.atomic(using=self.primary)
+
+    def get_execution(self, root_node, output, streaming=False):
+        return neonode.Execution(
+            root_node.nodes,
+            root_node.ctx,
+            output,
+            tracer=root_node.tracer,
+            streaming=streaming,
+        )
+
+    def get_root_node(self, request, cache):
+        return neonode.RootNode(
+            self.nodes,
+            ctx=request,
+            cache=cache,
+            budget=self.budget,
+            tracer=self.tracer,
+        )
+
+    def get_query(self, request, params=None):
+        """Text of the query requested and the cache where it is parsed
+
+        The parameters are taken from `params` or else the query string.
+        """
+        params = request.GET if params is None else params
+        query_id = params.get('id')
+        if query_id:
+            if self.persisted_queries is None:
+                raise UnknownQuery(query_id)
+            query = self.persisted_queries.get(query_id)
+            return query, self.persisted_queries.cache
+
+        if not self.allow_ad_hoc_queries:
+            raise AdHocQueryNotAllowed()
+        return params.get('query') or '', self.parse_cache
+
+    def get_variables(self, request, params=None):
+        params = request.GET if params is None else params
+        variables = params.get('variables')
+        if not variables:
+            return {}
+        if isinstance(variables, str):
+            try:
+                variables = json.loads(variables)
+            except ValueError as e:
+                raise Carbon14Error(f'Invalid variables: {e}')
+        if not isinstance(variables, dict):
+            raise Carbon14Error('Variables should be a JSON object.')
+        return variables
+
+    def encode(self, data, indent=None):
+        if self.tracer is not None:
+            with self.tracer.span('encode', ''):
+                return json.dumps(data, indent=indent)
+        return json.dumps(data, indent=indent)
+
     def render(self, **kwargs):
         return (
             self.template.render(RequestContext(self.request, kwargs)).encode()
@@ -48,3 +48,56 @@ class MissingFields(Carbon14Error):
             f'Node "{node_name}"" does not have this fields: '
             f'{missing_fields}'
         )
+
+
+class MissingVariable(Carbon14Error):
+
+    def __init__(self, name):
+        self.name = name
+        super().__init__(f'Missing value for variable "${name}".')
+
+
+class UnknownQuery(Carbon14Error):
+
+    def __init__(self, query_id):
+        super().__init__(f'There is no persisted query with id "{query_id}".')
+
+
+class AdHocQueryNotAllowed(Carbon14Error):
+
+    def __init__(self):
+        super().__init__('Only persisted queries are allowed.')
+
+
+class QueryTooExpensive(Carbon14Error):
+
+    def __init__(self, measure, value, budget):
+        self.measure = measure
+        self.value = value
+        self.budget = budget
+        super().__init__(
+            f'Query is too expensive: its {measure} is {value} and the '
+            f'maximum allowed is {budget}.'
+        )
+
+
+class UnknownFormat(Carbon14Error):
+
+    def __init__(self, format, formats):
+        super().__init__(
+            f'Unknown format "{format}", use one of: {", ".join(formats)}.'
+        )
+
+
+class InvalidCursor(Carbon14Error):
+
+    def __init__(self, cursor):
+        self.cursor = cursor
+        super().__init__(f'Invalid cursor "{cursor}".')
+
+
+class TooManyQueries(Carbon14Error):
+
+    def __init__(self, problems):
+        self.problems = problems
+        super().__init__('Too many SQL queries: ' + '; '.join(problems) + '.')
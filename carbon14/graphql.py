@@ -1,118 +1,208 @@
-
 import re
-import json
+import sys
 from collections import namedtuple
-from functools import lru_cache
+from json.decoder import scanstring
 
 
+from .cache import LRUCache
 from .errors import TokenizerError, LexicalError
 
 
 Token = namedtuple('Token', ['kind', 'value', 'line', 'column'])
 
 
-TOKENS = (
-    ('BRACKET_OPEN', r'{'),
-    ('BRACKET_CLOSE', r'}'),
-    ('PARENTHESIS_OPEN', r'\('),
-    ('PARENTHESIS_CLOSE', r'\)'),
-    ('SQUARE_BRACKET_OPEN', r'\['),
-    ('SQUARE_BRACKET_CLOSE', r'\]'),
-    ('NULL', r'null'),
-    ('BOOL', r'(true|false)'),
-    ('NAME', r'[a-zA-Z_]\w*'),
-    ('COLON', r':'),
-    ('COMMA', r','),
-    ('NUMBER', r'-?(?:0|[1-9]\d*)(?:\.\d+)?(?:[eE][+-]?\d+)?'),
-    ('STRING', r'\"([^\\\"]|\\.)*\"'),
-    ('NEW_LINE', r'\n'),
-    ('WHITE_SPACE', r'\s+'),
-    ('MISMATCH', r'.'),
+class Variable(namedtuple('Variable', ['name'])):
+    """Value of a parameter given when the query is executed: `$name`"""
+
+
+PUNCTUATION = {
+    '{': 'BRACKET_OPEN',
+    '}': 'BRACKET_CLOSE',
+    '(': 'PARENTHESIS_OPEN',
+    ')': 'PARENTHESIS_CLOSE',
+    '[': 'SQUARE_BRACKET_OPEN',
+    ']': 'SQUARE_BRACKET_CLOSE',
+    ':': 'COLON',
+    ',': 'COMMA',
+}
+
+KEYWORDS = {
+    'null': ('NULL', None),
+    'true': ('BOOL', True),
+    'false': ('BOOL', False),
+}
+
+NAME_START = frozenset(
+    'abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ_'
 )
+NUMBER_START = frozenset('-0123456789')
+
+NAME_REGEX = re.compile(r'[a-zA-Z_]\w*')
+NUMBER_REGEX = re.compile(r'-?(?:0|[1-9]\d*)(\.\d+)?([eE][+-]?\d+)?')
+WHITE_SPACE_REGEX = re.compile(r'\s+')
 
-TOKEN_REGEX = re.compile('|'.join('(?P<%s>%s)' % pair for pair in TOKENS))
+SCALARS = ('STRING', 'NUMBER', 'BOOL', 'NULL', 'VARIABLE')
 
 
 def tokenize(string):
-    line_num = 1
-    line_start = 0
+    parser = Parser(string)
     tokens = []
-    for mo in TOKEN_REGEX.finditer(string):
-        kind = mo.lastgroup
-        value = mo.group(kind)
-        column = mo.start() - line_start + 1
-        if kind == 'NEW_LINE':
-            line_start = mo.end()
-            line_num += 1
-        elif kind == 'WHITE_SPACE':
-            pass
-        elif kind == 'MISMATCH':
-            raise TokenizerError(value, line_num, column)
-        else:
-            tokens.append(Token(kind, value, line_num, column))
-
-    # add first {
-    tokens.insert(0, Token('BRACKET_OPEN', '{', 1, 0))
-
-    # add last }
-    last_token = tokens[-1]
-    tokens.append(Token(
-        'BRACKET_CLOSE', '}', last_token.line, last_token.column + 1
-    ))
+    while parser.kind is not None:
+        tokens.append(
+            Token(parser.kind, parser.text, parser.line, parser.column)
+        )
+        parser.advance()
     return tuple(tokens)
 
 
 class Parser:
-    def __init__(self, tokens):
-        self.tokens = tokens
-        self.cursor = 0
+    """Single pass parser working directly over the query string
+
+    The scanner keeps only the current token: its `kind`, its decoded
+    `value` and where it is. As the query is a list of entries without the
+    wrapping `{ }`, a first `{` and a last `}` are emitted around them.
+    """
+
+    def __init__(self, query):
+        self.query = query
+        self.length = len(query)
+        self.pos = 0
+        self.line_number = 1
+        self.line_start = 0
+        self.closed = False
+
+        # add first {
+        self.kind = 'BRACKET_OPEN'
+        self.value = '{'
+        self.start = None
+        self.line = self.last_line = 1
+        self.column = self.last_column = 0
 
     @property
-    def current(self):
-        try:
-            return self.tokens[self.cursor]
-        except IndexError:
-            last_token = self.tokens[-1] if self.tokens else None
-            if last_token:
-                raise LexicalError(
-                    value=last_token.value,
-                    line=last_token.line,
-                    column=last_token.column,
-                )
+    def text(self):
+        """Source text of the current token"""
+        if self.start is None:
+            return self.value
+        return self.query[self.start:self.pos]
+
+    def advance(self):
+        query = self.query
+        pos = self.pos
+        if pos < self.length and query[pos].isspace():
+            pos = WHITE_SPACE_REGEX.match(query, pos).end()
+            new_lines = query.count('\n', self.pos, pos)
+            if new_lines:
+                self.line_number += new_lines
+                self.line_start = query.rfind('\n', self.pos, pos) + 1
+
+        if pos >= self.length:
+            self.pos = pos
+            self.start = None
+            if self.closed:
+                self.kind = self.value = None
+            else:
+                # add last }
+                self.closed = True
+                self.kind = 'BRACKET_CLOSE'
+                self.value = '}'
+                self.line = self.last_line
+                self.column = self.last_column + 1
+            return
+
+        char = query[pos]
+        line = self.line_number
+        column = pos - self.line_start + 1
+        kind = PUNCTUATION.get(char)
+        if kind:
+            value = char
+            end = pos + 1
+        elif char in NAME_START:
+            end = NAME_REGEX.match(query, pos).end()
+            value = query[pos:end]
+            kind, value = KEYWORDS.get(value, ('NAME', value))
+        elif char == '"':
+            kind = 'STRING'
+            try:
+                value, end = scanstring(query, pos + 1)
+            except ValueError:
+                raise TokenizerError(char, line, column)
+        elif char == '$':
+            match = NAME_REGEX.match(query, pos + 1)
+            if not match:
+                raise TokenizerError(char, line, column)
+            kind = 'VARIABLE'
+            end = match.end()
+            value = Variable(query[pos + 1:end])
+        elif char in NUMBER_START:
+            match = NUMBER_REGEX.match(query, pos)
+            if not match:
+                raise TokenizerError(char, line, column)
+            kind = 'NUMBER'
+            end = match.end()
+            fraction, exponent = match.groups()
+            if fraction or exponent:
+                value = float(query[pos:end])
             else:
-                raise LexicalError()
-
-    def consume(self, kinds, null=False):
-        if isinstance(kinds, str):
-            kinds = [kinds]
-        if self.current.kind in kinds:
-            token = self.current
-            self.cursor += 1
-            return token
-        if not null:
+                value = int(query[pos:end])
+        else:
+            raise TokenizerError(char, line, column)
+
+        self.kind = kind
+        self.value = value
+        self.start = pos
+        self.pos = end
+        self.line = self.last_line = line
+        self.column = self.last_column = column
+
+    def consume(self, kind):
+        if self.kind != kind:
+            self.unexpected((kind,))
+        value = self.value
+        self.advance()
+        return value
+
+    def skip(self, kind):
+        """Consume the current token if it is of `kind`"""
+        if self.kind is None:
+            self.unexpected()
+        if self.kind == kind:
+            self.advance()
+            return True
+        return False
+
+    def unexpected(self, expected_kinds=None):
+        if self.kind is None:
             raise LexicalError(
-                value=self.current.value,
-                line=self.current.line,
-                column=self.current.column,
-                expected_kinds=kinds,
+                value='}',
+                line=self.line,
+                column=self.column,
             )
+        raise LexicalError(
+            value=self.text,
+            line=self.line,
+            column=self.column,
+            expected_kinds=expected_kinds,
+        )
 
     def parse(self):
-        return self.parse_fields({})
+        ast = self.parse_fields({})
+        # what is left after closing the query is ignored, but still scanned
+        while self.kind is not None:
+            self.advance()
+        return ast
 
     def parse_fields(self, ast):
         """ FIELDS := { ENTRY* } """
-        token = self.consume('BRACKET_OPEN', null=True)
-        if token:
-            while self.current.kind != 'BRACKET_CLOSE':
+        if self.skip('BRACKET_OPEN'):
+            while self.kind != 'BRACKET_CLOSE':
                 ast = self.parse_entry(ast)
             self.consume('BRACKET_CLOSE')
         return ast
 
     def parse_entry(self, ast):
         """ ENTRY := PARAMETERS FIELDS """
-        token = self.consume('NAME')
-        ast[token.value] = {
+        name = self.consume('NAME')
+        ast[name] = {
             'kwargs': self.parse_kwargs({}),
             'fields': self.parse_fields({}),
         }
@@ -122,12 +212,10 @@ class Parser:
         """ KWARGS := ( [PARAMETER[,]]* )
             KWARGS := null
         """
-        token = self.consume('PARENTHESIS_OPEN', null=True)
-        if token:
-            while self.current.kind != 'PARENTHESIS_CLOSE':
+        if self.skip('PARENTHESIS_OPEN'):
+            while self.kind != 'PARENTHESIS_CLOSE':
                 ast = self.parse_parameter(ast)
-                comma = self.consume('COMMA', null=True)
-                if not comma:
+                if not self.skip('COMMA'):
                     break
             self.consume('PARENTHESIS_CLOSE')
         return ast
@@ -136,27 +224,29 @@ class Parser:
         """ PARAMETER := NAME : VALUE """
         name = self.consume('NAME')
         self.consume('COLON')
-        ast[name.value] = self.consume_value()
+        ast[name] = self.consume_value()
         return ast
 
     def consume_value(self):
-        """ VALUE = STRING | NUMBER | BOOL | NULL | LIST | DICT """
-        if self.current.kind == 'SQUARE_BRACKET_OPEN':
+        """ VALUE = STRING | NUMBER | BOOL | NULL | VARIABLE | LIST | DICT """
+        kind = self.kind
+        if kind == 'SQUARE_BRACKET_OPEN':
             return self.consume_list()
-        elif self.current.kind == 'BRACKET_OPEN':
+        elif kind == 'BRACKET_OPEN':
             return self.consume_dict()
-        else:
-            token = self.consume(['STRING', 'NUMBER', 'BOOL', 'NULL'])
-        return json.loads(token.value)
+        elif kind in SCALARS:
+            value = self.value
+            self.advance()
+            return value
+        self.unexpected(SCALARS)
 
     def consume_list(self):
         """ LIST = [ [VALUE[,]]* ] """
         the_list = []
         self.consume('SQUARE_BRACKET_OPEN')
-        while self.current.kind != 'SQUARE_BRACKET_CLOSE':
+        while self.kind != 'SQUARE_BRACKET_CLOSE':
             the_list.append(self.consume_value())
-            comma = self.consume('COMMA', null=True)
-            if not comma:
+            if not self.skip('COMMA'):
                 break
         self.consume('SQUARE_BRACKET_CLOSE')
         return the_list
@@ -165,22 +255,100 @@ class Parser:
         """ DICT = { [(STRING|NAME): VALUE[,]]* } """
         the_dict = {}
         self.consume('BRACKET_OPEN')
-        while self.current.kind != 'BRACKET_CLOSE':
-            key = self.consume(['STRING', 'NAME'])
-            if key.kind == 'STRING':
-                key = key.value.strip('"')
-            else:
-                key = key.value
+        while self.kind != 'BRACKET_CLOSE':
+            if self.kind not in ('STRING', 'NAME'):
+                self.unexpected(('STRING', 'NAME'))
+            key = self.value
+            self.advance()
             self.consume('COLON')
             the_dict[key] = self.consume_value()
-            comma = self.consume('COMMA', null=True)
-            if not comma:
+            if not self.skip('COMMA'):
                 break
         self.consume('BRACKET_CLOSE')
         return the_dict
 
 
-@lru_cache()
-def parse(query):
-    tokens = tokenize(query)
-    return Parser(tokens).parse()
+class FrozenDict(dict):
+    """A parsed dict that can't be modified, so it can be shared"""
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError(f'{type(self).__name__} is immutable')
+
+    __setitem__ = __delitem__ = __ior__ = _immutable
+    clear = pop = popitem = setdefault = update = _immutable
+
+
+class FrozenList(list):
+    """A parsed list that can't be modified, so it can be shared"""
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError(f'{type(self).__name__} is immutable')
+
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _immutable
+    append = extend = insert = pop = remove = clear = _immutable
+    sort = reverse = _immutable
+
+
+def freeze(value):
+    """Immutable copy of the parsed `value` and its approximate size"""
+    if isinstance(value, dict):
+        size = sys.getsizeof(value)
+        frozen = {}
+        for key, item in value.items():
+            frozen[key], item_size = freeze(item)
+            size += item_size
+        return FrozenDict(frozen), size
+    elif isinstance(value, list):
+        size = sys.getsizeof(value)
+        frozen = []
+        for item in value:
+            item, item_size = freeze(item)
+            frozen.append(item)
+            size += item_size
+        return FrozenList(frozen), size
+    else:
+        return value, sys.getsizeof(value)
+
+
+class Document:
+    """A parsed query as stored in the `ParseCache`
+
+    The compiled plans of the query for each schema are stored here, so they
+    share the life of the parsed query in the cache.
+    """
+    __slots__ = ('ast', 'size', 'plans')
+
+    def __init__(self, ast, size):
+        self.ast = ast
+        self.size = size
+        self.plans = {}
+
+
+class ParseCache(LRUCache):
+    """Cache of the immutable ASTs of the parsed queries
+
+    Entries are evicted when there are more than `max_entries` or their
+    approximate size in memory is over `max_bytes`.
+    """
+
+    def __init__(self, max_entries=128, max_bytes=16 * 1024 * 1024):
+        super().__init__(max_entries=max_entries, max_bytes=max_bytes)
+
+    def document(self, query):
+        document = self.get(query)
+        if document is None:
+            ast, size = freeze(Parser(query).parse())
+            document = Document(ast, size + sys.getsizeof(query))
+            self.set(query, document, size=document.size)
+        return document
+
+    def parse(self, query):
+        return self.document(query).ast
+
+
+parse_cache = ParseCache()
+
+
+def parse(query, cache=None):
+    """Immutable AST of `query`, shared by all the callers"""
+    return (cache or parse_cache).parse(query)
@@ -32,15 +32,60 @@ def default(o):
     return DjangoJSONEncoder().default(o)
 
 
+OPTION = orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
+
+
 def dumps(obj, indent=False, default=default):
-    option = (
-        orjson.OPT_NON_STR_KEYS | orjson.OPT_SERIALIZE_NUMPY
-    )
+    option = OPTION
     if indent:
         option |= orjson.OPT_INDENT_2
     return orjson.dumps(obj, default=default, option=option).decode()
 
 
+def iterdumps(obj, default=default, depth=2, chunk_size=64 * 1024):
+    """Encode `obj` to JSON in chunks of bytes of about `chunk_size`
+
+    The dicts and collections (lists, tuples and generators) in the first
+    `depth` levels of `obj` are walked, so the items of the collections are
+    encoded one by one as they are produced. The output is the same as
+    `dumps(obj)`.
+    """
+    chunk = []
+    size = 0
+    for part in iterencode(obj, default, depth):
+        chunk.append(part)
+        size += len(part)
+        if size >= chunk_size:
+            yield b''.join(chunk)
+            chunk = []
+            size = 0
+    if chunk:
+        yield b''.join(chunk)
+
+
+def iterencode(obj, default, depth):
+    if depth and isinstance(obj, dict):
+        yield b'{'
+        separator = b''
+        for key, value in obj.items():
+            if not isinstance(key, str):
+                key = orjson.dumps(key, default=default).decode().strip('"')
+            yield separator + orjson.dumps(key) + b':'
+            yield from iterencode(value, default, depth - 1)
+            separator = b','
+        yield b'}'
+    elif depth and isinstance(obj, (list, tuple, Generator)):
+        yield b'['
+        separator = b''
+        for item in obj:
+            yield separator
+            yield from iterencode(item, default, depth - 1)
+            separator = b','
+        yield b']'
+    else:
+        yield orjson.dumps(obj, default=default, option=OPTION)
+
+
 class Encoder:
     def __init__(self, *args, **kwargs):
         pass
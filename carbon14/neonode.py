@@ -1,50 +1,258 @@
 from __future__ import annotations
+from asyncio import gather
+from collections.abc import Iterator
 from functools import partial
+from inspect import isawaitable
 
-from .errors import MissingNode, MissingFields
-from .utils import import_string, get_first_of
+from .codegen import serializer_for
+from .errors import MissingNode, MissingFields, UnknownFormat
+from .plan import Selection, compile_query, compile_selection, \
+    compile_query_text, bind_variables
+from .utils import import_string, get_first_of, pk_of
 
 
 class RootNode:
 
-    def __init__(self, nodes, ctx=None):
+    def __init__(
+        self, nodes, ctx=None, cache=None, budget=None, tracer=None,
+    ):
         nodes = [import_string(n) if isinstance(n, str) else n for n in nodes]
         self.nodes = {c.Meta.name: c for c in nodes}
+        self.schema = tuple(self.nodes.items())
         self.ctx = ctx
+        self.cache = cache
+        self.budget = budget
+        # `carbon14.tracing.Tracer` of the executions of this root node
+        self.tracer = tracer
 
-    def query(self, query):
+    def compile(self, query):
+        """Compile `query` into a plan
+
+        `query` can be the text of a query, whose plan is cached per schema
+        in `self.cache` (a `ParseCache`), or an already parsed query.
+        """
+        if isinstance(query, str):
+            if self.tracer is not None:
+                with self.tracer.span('parse', ''):
+                    return compile_query_text(self.schema, query, self.cache)
+            return compile_query_text(self.schema, query, self.cache)
+        return compile_query(self.nodes, query)
+
+    def is_read_only(self, query):
+        """Whether `query` (text or plan) has no mutation fields, so it can
+        be solved with a read-only access to the data
+        """
+        if not isinstance(query, Selection):
+            query = self.compile(query)
+        return not query.mutates
+
+    def query(self, query, variables=None, execution=None, format='nested'):
         """
         query = {'book': {'kwargs': {}, 'fields': `query`}}
+
+        `variables` has the values of the `$variables` used in the query.
+        The query is solved in a new `Execution` with the given `format`
+        unless one is given. In the `'normalized'` format the answer is:
+
+        {'roots': {'book': [ids...]}, 'entities': {'book': {id: {...}}}}
         """
-        return {
-            field: self.solve(field, **data)
-            for field, data in query.items()
-        }
+        if not isinstance(query, Selection):
+            query = self.compile(query)
+        query = bind_variables(query, variables or {})
+        if self.budget is not None:
+            self.budget.check(query)
+        execution = execution or Execution(
+            self.nodes, self.ctx, format, tracer=self.tracer,
+        )
+        if query.mutates:
+            execution.memo = None
+            execution.cache = None
+        data = {plan.name: self.solve(plan, execution) for plan in query}
+        if execution.entities is not None:
+            data = {'roots': data, 'entities': execution.entities}
+        return data
+
+    async def aquery(self, query, variables=None, execution=None):
+        """Like `query` but the fields can be solved by `async def` resolvers
+        and filters, and the root entries and sibling fields are solved
+        concurrently.
+        """
+        if not isinstance(query, Selection):
+            query = self.compile(query)
+        query = bind_variables(query, variables or {})
+        if self.budget is not None:
+            self.budget.check(query)
+        execution = execution or Execution(
+            self.nodes, self.ctx, tracer=self.tracer,
+        )
+        if query.mutates:
+            execution.cache = None
+        values = await gather(*(
+            self.asolve(plan, execution) for plan in query
+        ))
+        return {plan.name: value for plan, value in zip(query, values)}
+
+    async def asolve(self, plan, execution):
+        node = self.nodes.get(plan.name)
+        if not node or not node.Meta.exposed:
+            raise MissingNode(plan.name)
+        return await execution.node(node).aquery(plan.kwargs, plan.fields)
 
-    def solve(self, field, **data):
-        node = self.nodes.get(field)
+    def solve(self, plan, execution):
+        node = self.nodes.get(plan.name)
         if not node or not node.Meta.exposed:
-            raise MissingNode(field)
-        return node(self.ctx, self.nodes).query(**data)
+            raise MissingNode(plan.name)
+        if execution.tracer is not None:
+            # the items are serialized inside the span
+            with execution.tracer.span('solve', plan.path):
+                data = execution.node(node).query(plan.kwargs, plan.fields)
+                return list(data) if isinstance(data, Iterator) else data
+        return execution.node(node).query(plan.kwargs, plan.fields)
+
+
+class Execution:
+    """State of solving queries for a request
+
+    It owns the only instance of each node class used while solving, and it
+    is the place for the caches that live as long as the request: `cache`.
+
+    `format` is how the data is returned:
+
+    - `'nested'`: the items have the items of their related fields inside.
+    - `'normalized'`: each item is stored once in `entities`, as
+      `{node_name: {id: item}}`, and the related fields have their ids.
+    - `'columnar'`: each collection is `{field_name: [values...]}`, with
+      the related items of all its items in the same way plus a `'_parent'`
+      column with the index of the item they belong to.
+
+    `tracer` is the `carbon14.tracing.Tracer` that gets its spans, if any,
+    and `using` the database the sources are read from, for the nodes that
+    support choosing it (`None` for their default). With `streaming` the
+    answer is encoded while the items of its collections are produced, so
+    nothing that grows with it (like the memo) is kept.
+    """
+    FORMATS = ('nested', 'normalized', 'columnar')
+
+    def __init__(
+        self, nodes, ctx=None, format='nested', tracer=None, using=None,
+        streaming=False,
+    ):
+        if format not in self.FORMATS:
+            raise UnknownFormat(format, self.FORMATS)
+        self.nodes = nodes
+        self.ctx = ctx
+        self.format = format
+        self.tracer = tracer
+        self.using = using
+        self.streaming = streaming
+        self.instances = {}
+        # items fetched by the roots, {key: items}, reused by the queries of
+        # a batch until one of them is a mutation
+        self.cache = {}
+        # values of the fields solved by `Node.prefetch`
+        self.batches = {}
+        self.entities = {} if format == 'normalized' else None
+        # (node name, pk, selection id) of the entities already normalized
+        self.walked = set()
+        # nested items already serialized, {(selection id, pk): data}, used
+        # only when nothing in the query is a mutation
+        self.memo = {} if format == 'nested' and not streaming else None
+        self.memo_hits = 0
+
+    def node(self, node_class):
+        """The instance of `node_class` for this execution"""
+        try:
+            return self.instances[node_class]
+        except KeyError:
+            return node_class(self.ctx, self.nodes, execution=self)
+
+
+NOT_SOLVED = object()
+
+
+class Fetched(list):
+    """Items of a nested collection already fetched by `Node.prefetch`"""
+
+
+def as_list(items):
+    """`items` as a list, keeping the pages"""
+    return items if isinstance(items, Page) else list(items)
+
+
+class Page(list):
+    """Items of a page of a collection, returned by `Node.fetch`
+
+    The collection is answered as `{'items': [...], 'page': info}`.
+    """
+
+    def __init__(self, items, info):
+        super().__init__(items)
+        self.info = info
 
 
 class Field:
-    def __init__(self, node_type=None):
+    # does it return a collection? (`None` is unknown)
+    many = None
+    # does its resolver get all the instances of a level at once?
+    batched = False
+    # does it change something? (so it can't be memoized or cached)
+    mutation = False
+
+    def __init__(self, node_type=None, many=None, cache=None, mutation=None):
         self.node_type = node_type
+        if many is not None:
+            self.many = many
+        if mutation is not None:
+            self.mutation = mutation
+        # `carbon14.cache.FieldCache` for the values of this field
+        self.cache = cache
+
+    @classmethod
+    def batch(cls, *args, **kwargs):
+        """Field whose resolver solves all the instances of a level at once
+
+        The resolver is called as `resolver(node, instances, **kwargs)` and
+        returns the values for the `instances` in the same order.
+        """
+        field = cls(*args, **kwargs)
+        field.batched = True
+        return field
 
     def __call__(self, resolver):
         self.resolver = resolver
         return self
 
     def resolve(self, node: Node, instance, kwargs):
+        if self.cache is not None:
+            return self.cache.resolve(self, node, instance, kwargs)
+        return self.solve(node, instance, kwargs)
+
+    def solve(self, node: Node, instance, kwargs):
+        """Value of this field for `instance`, without caching"""
         value = partial(self.resolver, node, instance)
         if callable(value):
             value = value(**kwargs)
         return value
 
+    def resolve_batch(self, node: Node, instances, kwargs):
+        """Values of this field for all the `instances`"""
+        if self.batched:
+            return list(self.resolver(node, instances, **kwargs))
+        return [self.resolve(node, instance, kwargs) for instance in instances]
+
     def resolver(self, node, instance, **kwargs):
         return get_first_of(instance, self.name)
 
+    @property
+    def is_plain(self):
+        """If the value of this field is just the key/attribute `name`"""
+        return (
+            type(self).resolve is Field.resolve and
+            type(self).resolver is Field.resolver and
+            'resolver' not in vars(self) and
+            self.cache is None
+        )
+
 
 class Node:
 
@@ -70,50 +278,359 @@ class Node:
         source = ()
         fields = ()
         field_class = Field
+        # generate a specialized serializer for each selection of fields
+        compile_serializers = False
+        # build the numeric columns of the 'columnar' format as NumPy arrays
+        numpy_columns = False
+        # cost hints: items of the source when no limit is given, and items
+        # per parent of the fields, {field_name: items}
+        estimated_rows = 100
+        fan_out = {}
 
-    def __init__(self, ctx, nodes):
+    def __init__(self, ctx, nodes, execution=None):
         self.ctx = ctx
         self.nodes = nodes
+        self.execution = execution or Execution(nodes, ctx)
+        self.execution.instances.setdefault(type(self), self)
 
     def query(self, kwargs, fields, source=None):
-        self.check_if_requesting_missing_fields(fields)
-        source = self.Meta.source if source is None else source
-        items = self.filter(_source=source, **kwargs)
+        fields = self.compile(fields)
+        items = self.fetch(kwargs, fields, source)
+        if isinstance(items, Page):
+            data = self.serialize_items(items, fields)
+            if isinstance(data, Iterator):
+                data = list(data)
+            return {'items': data, 'page': items.info}
+        return self.serialize_items(items, fields)
+
+    def serialize_items(self, items, fields):
+        """Serialize the fetched `items` in the format of the execution"""
+        if fields.batched:
+            items = list(items)
+            self.prefetch(items, fields)
+        if self.execution.format == 'columnar':
+            return self.serialize_columns(list(items), fields)
+        if self.execution.entities is not None:
+            return [self.normalize(item, fields) for item in items]
         return (self.serialize(item, fields) for item in items)
 
-    def check_if_requesting_missing_fields(self, fields):
+    async def aquery(self, kwargs, fields, source=None):
+        """Async version of `query`, returning a list (or a page)
+
+        Batched fields are still solved synchronously by `prefetch`.
+        """
+        fields = self.compile(fields)
+        items = await self.afetch(kwargs, fields, source)
+        if fields.batched:
+            self.prefetch(items, fields)
+        data = list(await gather(*(
+            self.aserialize(item, fields) for item in items
+        )))
+        if isinstance(items, Page):
+            return {'items': data, 'page': items.info}
+        return data
+
+    async def afetch(self, kwargs, fields, source=None):
+        """List (or `Page`) of the items of `fetch`, that can be awaitable"""
+        items = self.fetch(kwargs, fields, source)
+        if isawaitable(items):
+            items = await items
+        return as_list(items)
+
+    def fetch(self, kwargs, fields, source=None):
+        """Items of `source` (by default `Meta.source`) to be serialized"""
+        source = self.Meta.source if source is None else source
+        return self.filtered(source, kwargs, fields)
+
+    def prefetch(self, items, fields):
+        """Solve at once for all the `items` the batched fields of `fields`
+
+        The fields leading to nested batched fields are solved too, and their
+        nested items fetched, so each level is prefetched all together.
+        """
+        solved = self.execution.batches
+        for plan in fields:
+            if not (plan.field.batched or plan.fields.batched):
+                continue
+
+            values = plan.field.resolve_batch(self, items, plan.kwargs)
+            if plan.fields.batched:
+                node = self.execution.node(plan.node)
+                nested_items = {}
+                for i, value in enumerate(values):
+                    if value is None:
+                        continue
+                    if node.is_collection(value):
+                        value = values[i] = Fetched(
+                            node.fetch(plan.kwargs, plan.fields, value)
+                        )
+                        nested_items.update((id(v), v) for v in value)
+                    else:
+                        nested_items[id(value)] = value
+                node.prefetch(list(nested_items.values()), plan.fields)
+
+            for item, value in zip(items, values):
+                solved[id(plan), id(item)] = value
+
+    def compile(self, fields):
+        """Compiled selection of `fields`, that can be already compiled"""
+        if isinstance(fields, Selection):
+            return fields
+        return compile_selection(type(self), fields, self.nodes)
+
+    @classmethod
+    def check_if_requesting_missing_fields(cls, fields):
         fields_to_solve = {
             f: v
             for f, v in fields.items()
-            if f in self._fields
+            if f in cls._fields
         }
         missing_fields = set(fields) - set(fields_to_solve)
         if missing_fields:
-            raise MissingFields(self.Meta.name, missing_fields)
+            raise MissingFields(cls.Meta.name, missing_fields)
 
     def filter(self, _source, **kwargs):
         return _source
 
+    def filtered(self, source, kwargs, fields):
+        """`filter` the `source` of the items of `fields` by `kwargs`"""
+        tracer = self.execution.tracer
+        if tracer is not None:
+            with tracer.span('filter', fields.path):
+                return self.filter(_source=source, **kwargs)
+        return self.filter(_source=source, **kwargs)
+
     def serialize(self, item, item_fields):
+        if self.execution.tracer is not None:
+            return self.serialize_traced(item, item_fields)
+        if item_fields.batched:
+            return self.serialize_prefetched(item, item_fields)
+        if self.Meta.compile_serializers:
+            return serializer_for(item_fields)(self, item, item_fields)
         result = {}
-        for field_name, data in item_fields.items():
-            kwargs = data.get('kwargs', {})
-            fields = data.get('fields', {})
+        for plan in item_fields:
+            value = plan.field.resolve(self, item, plan.kwargs)
+            if value is not None and plan.node:
+                value = self.serialize_related_field(value, plan)
+            result[plan.name] = value
+        return result
 
-            value = self.resolve(item, field_name, kwargs)
-            node = self.get_node_for(field_name)
-            if value is not None and node:
-                value = self.serialize_related_field(value, node, fields, data)
+    def serialize_traced(self, item, item_fields):
+        """`serialize` reporting the spans of the fields to the tracer"""
+        span = self.execution.tracer.span
+        result = {}
+        for plan in item_fields:
+            with span('resolve', plan.path):
+                if item_fields.batched:
+                    value = self.resolve_prefetched(item, plan)
+                else:
+                    value = plan.field.resolve(self, item, plan.kwargs)
+            if value is not None and plan.node:
+                with span('related', plan.path):
+                    value = self.serialize_related_field(value, plan)
+            result[plan.name] = value
+        return result
 
-            result[field_name] = value
+    def serialize_prefetched(self, item, item_fields):
+        """Serialize `item` taking the values solved by `prefetch`"""
+        result = {}
+        for plan in item_fields:
+            value = self.resolve_prefetched(item, plan)
+            if value is not None and plan.node:
+                value = self.serialize_related_field(value, plan)
+            result[plan.name] = value
         return result
 
-    def serialize_related_field(self, value, node, fields, data):
-        if fields:
-            if node.is_collection(value):
-                value = node.query(source=value, **data)
+    def serialize_memoized(self, item, item_fields):
+        """Serialize `item` or reuse its data if it was already serialized
+        with the same fields during the execution
+        """
+        pk = pk_of(item)
+        if pk is None:
+            return self.serialize(item, item_fields)
+        key = (id(item_fields), pk)
+        memo = self.execution.memo
+        try:
+            data = memo[key][1]
+        except KeyError:
+            data = self.serialize(item, item_fields)
+            # the selection is kept so its id is not reused while memoized
+            memo[key] = (item_fields, data)
+        else:
+            self.execution.memo_hits += 1
+        return data
+
+    def serialize_columns(self, items, item_fields, parents=None):
+        """Serialize `items` as `{field_name: [values...]}`
+
+        The related items of a field are serialized the same way, all of
+        them together, with the column `'_parent'` having the `parents`
+        (index of the item each one belongs to).
+        """
+        columns = {} if parents is None else {'_parent': parents}
+        for plan in item_fields:
+            if item_fields.batched:
+                values = [
+                    self.resolve_prefetched(item, plan) for item in items
+                ]
+            else:
+                values = [
+                    plan.field.resolve(self, item, plan.kwargs)
+                    for item in items
+                ]
+            if plan.node:
+                values = self.serialize_related_column(values, plan)
+            else:
+                values = self.column(values)
+            columns[plan.name] = values
+        return columns
+
+    def serialize_related_column(self, values, plan):
+        node = self.execution.node(plan.node)
+        if not plan.fields:
+            return [
+                None if value is None else
+                self.serialize_related_field(value, plan)
+                for value in values
+            ]
+        items = []
+        parents = []
+        pages = []
+        for i, value in enumerate(values):
+            if value is None:
+                nested_items = ()
+            elif isinstance(value, Fetched):
+                nested_items = value
+            elif node.is_collection(value):
+                nested_items = node.fetch(plan.kwargs, plan.fields, value)
+            else:
+                nested_items = (value,)
+            pages.append(getattr(nested_items, 'info', None))
+            for item in nested_items:
+                items.append(item)
+                parents.append(i)
+        columns = node.serialize_columns(
+            items, plan.fields, node.column(parents),
+        )
+        if any(page is not None for page in pages):
+            # the page of the items of each parent
+            columns['_pages'] = pages
+        return columns
+
+    def column(self, values):
+        """`values` of a column, as a NumPy array if they are numbers and
+        `Meta.numpy_columns` is set
+        """
+        if not self.Meta.numpy_columns or not values:
+            return values
+        types = set(map(type, values))
+        if types <= {int, float}:
+            import numpy
+            try:
+                return numpy.array(values)
+            except OverflowError:
+                pass
+        return values
+
+    def resolve_prefetched(self, item, plan):
+        """Value of `plan` for `item`, as solved by `prefetch` if it was"""
+        value = self.execution.batches.get((id(plan), id(item)), NOT_SOLVED)
+        if value is NOT_SOLVED:
+            [value] = plan.field.resolve_batch(self, [item], plan.kwargs)
+        return value
+
+    def normalize(self, item, item_fields):
+        """Store `item` in the entities of the execution and return its id
+
+        If the entity was already stored only the fields it is missing are
+        solved and added to it, and the related fields it has are solved
+        again to add the fields missing in the related entities. Items
+        without `pk` or `id` can't be stored, so they are returned inline.
+        """
+        pk = pk_of(item)
+        if pk is None:
+            return self.serialize(item, item_fields)
+        walked = (self.Meta.name, pk, id(item_fields))
+        if walked in self.execution.walked:
+            return pk
+        self.execution.walked.add(walked)
+        entities = self.execution.entities.setdefault(self.Meta.name, {})
+        entity = entities.get(pk)
+        if entity is None:
+            entity = entities[pk] = {}
+        for plan in item_fields:
+            if plan.name in entity and not (plan.node and plan.fields):
+                continue
+            if item_fields.batched:
+                value = self.resolve_prefetched(item, plan)
+            else:
+                value = plan.field.resolve(self, item, plan.kwargs)
+            if value is not None and plan.node:
+                value = self.serialize_related_field(value, plan)
+            entity.setdefault(plan.name, value)
+        return pk
+
+    async def aserialize(self, item, item_fields):
+        """Async version of `serialize`
+
+        Values that need to be awaited or serialized by other nodes are
+        solved concurrently.
+        """
+        result = {}
+        pending = []
+        for plan in item_fields:
+            if item_fields.batched:
+                value = self.resolve_prefetched(item, plan)
+            else:
+                value = plan.field.resolve(self, item, plan.kwargs)
+            if isawaitable(value) or value is not None and plan.node:
+                pending.append((plan.name, self.asolve_value(value, plan)))
+            result[plan.name] = value
+        if pending:
+            values = await gather(*(solving for _, solving in pending))
+            for (name, _), value in zip(pending, values):
+                result[name] = value
+        return result
+
+    async def asolve_value(self, value, plan):
+        if isawaitable(value):
+            value = await value
+        if value is not None and plan.node:
+            value = await self.aserialize_related_field(value, plan)
+        return value
+
+    async def aserialize_related_field(self, value, plan):
+        node = self.execution.node(plan.node)
+        if not plan.fields:
+            return self.serialize_related_field(value, plan)
+        elif isinstance(value, Fetched):
+            return list(await gather(*(
+                node.aserialize(item, plan.fields) for item in value
+            )))
+        elif node.is_collection(value):
+            return await node.aquery(plan.kwargs, plan.fields, source=value)
+        else:
+            return await node.aserialize(value, plan.fields)
+
+    def serialize_related_field(self, value, plan):
+        node = self.execution.node(plan.node)
+        if plan.fields:
+            memo = self.execution.memo
+            if self.execution.entities is not None:
+                serialize = node.normalize
+            elif memo is not None:
+                serialize = node.serialize_memoized
+            else:
+                serialize = node.serialize
+            if isinstance(value, Fetched):
+                value = [serialize(item, plan.fields) for item in value]
+            elif node.is_collection(value):
+                value = node.query(plan.kwargs, plan.fields, source=value)
+                if memo is not None and isinstance(value, Iterator):
+                    # the data can be reused, so it can't be a generator
+                    value = list(value)
             else:
-                value = node.serialize(value, fields)
+                value = serialize(value, plan.fields)
         else:
             if node.is_collection(value):
                 value = [v.id for v in value]
@@ -128,7 +645,7 @@ class Node:
         field = self._fields[field_name]
         OtherNode = self.nodes.get(field.node_type)
         if OtherNode:
-            return OtherNode(self.ctx, self.nodes)
+            return self.execution.node(OtherNode)
 
     def is_collection(self, value):
         return isinstance(value, (list, tuple, set))
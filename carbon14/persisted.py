@@ -0,0 +1,67 @@
+from hashlib import sha256
+from pathlib import Path
+
+from .errors import UnknownQuery
+from .graphql import ParseCache
+from .neonode import RootNode
+
+
+def query_id(query):
+    """Id of a persisted query: the sha256 hex digest of its text"""
+    return sha256(query.encode()).hexdigest()
+
+
+class PersistedQueries:
+    """Registry of the query documents that can be executed by id
+
+    The queries are parsed and compiled once with `compile`, and kept for
+    the life of the registry in its own `cache`.
+    """
+
+    def __init__(self, queries=()):
+        self.queries = {}
+        self.cache = ParseCache(max_entries=float('inf'), max_bytes=None)
+        for query in queries:
+            self.register(query)
+
+    @classmethod
+    def from_mapping(cls, mapping):
+        """Registry of the queries in `mapping`, that are also known by key"""
+        registry = cls()
+        for key, query in mapping.items():
+            registry.register(query, alias=key)
+        return registry
+
+    @classmethod
+    def from_directory(cls, path, pattern='*.graphql'):
+        """Registry of the queries in the files of `path` matching `pattern`
+
+        Each query is also known by the name of its file without extension.
+        """
+        registry = cls()
+        for filename in sorted(Path(path).glob(pattern)):
+            registry.register(filename.read_text(), alias=filename.stem)
+        return registry
+
+    def register(self, query, alias=None):
+        key = query_id(query)
+        self.queries[key] = query
+        if alias is not None:
+            self.queries[alias] = query
+        return key
+
+    def get(self, key):
+        """Text of the query registered as `key`"""
+        try:
+            return self.queries[key]
+        except KeyError:
+            raise UnknownQuery(key)
+
+    def __contains__(self, key):
+        return key in self.queries
+
+    def compile(self, nodes):
+        """Parse and compile all the queries against the schema of `nodes`"""
+        root_node = RootNode(nodes, cache=self.cache)
+        for query in set(self.queries.values()):
+            root_node.compile(query)
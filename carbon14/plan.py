@@ -0,0 +1,205 @@
+from __future__ import annotations
+from types import MappingProxyType
+from typing import NamedTuple, Optional, Mapping, Any
+
+from .errors import MissingNode, MissingVariable
+from .graphql import parse_cache, Variable
+
+
+class FieldPlan(NamedTuple):
+    """A validated field of a query with everything needed to solve it.
+
+    `field` is the `Field` of the node that solves this entry (`None` for the
+    entries of the root level), `node` the class of the node that serializes
+    its value (if any) and `fields` the compiled selection for that node.
+    `path` has the names of the fields leading to it, like `'books.author'`.
+    """
+    name: str
+    field: Any
+    node: Optional[type]
+    kwargs: Mapping
+    fields: Selection
+    path: str = ''
+
+
+class Selection(tuple):
+    """Immutable sequence of `FieldPlan` requested from a node.
+
+    Its attributes are used to cache what is derived from the selection, like
+    the generated serializer of `carbon14.codegen`.
+    """
+    # path of the field whose items have this selection ('' for the root)
+    path = ''
+    # names of the variables used in the kwargs of this selection
+    variables = frozenset()
+    # are there batched fields in this selection or nested in it?
+    batched = False
+    # are there mutation fields in this selection or nested in it?
+    mutates = False
+
+
+EMPTY_KWARGS = MappingProxyType({})
+EMPTY_SELECTION = Selection()
+
+
+def compile_query(nodes, query):
+    """Compile a parsed `query` against `nodes` ({name: Node class})
+
+    query = {'book': {'kwargs': {}, 'fields': `query`}}
+    """
+    plans = []
+    for name, data in query.items():
+        node = nodes.get(name)
+        if not node or not node.Meta.exposed:
+            raise MissingNode(name)
+        plans.append(FieldPlan(
+            name=name,
+            field=None,
+            node=node,
+            kwargs=bind_kwargs(data.get('kwargs')),
+            fields=compile_selection(
+                node, data.get('fields') or {}, nodes, path=name
+            ),
+            path=name,
+        ))
+    return make_selection(plans)
+
+
+def compile_selection(node, fields, nodes, path=''):
+    """Compile the parsed `fields` requested from the `node` class"""
+    node.check_if_requesting_missing_fields(fields)
+    plans = []
+    for name, data in fields.items():
+        field = node._fields[name]
+        other_node = nodes.get(field.node_type)
+        field_path = f'{path}.{name}' if path else name
+        if other_node:
+            subfields = compile_selection(
+                other_node, data.get('fields') or {}, nodes, path=field_path
+            )
+        else:
+            subfields = EMPTY_SELECTION
+        plans.append(FieldPlan(
+            name=name,
+            field=field,
+            node=other_node,
+            kwargs=bind_kwargs(data.get('kwargs')),
+            fields=subfields,
+            path=field_path,
+        ))
+    return make_selection(plans, path)
+
+
+def make_selection(plans, path=''):
+    selection = Selection(plans)
+    if path:
+        selection.path = path
+    variables = set()
+    for plan in plans:
+        variables.update(variables_in(plan.kwargs))
+        variables.update(plan.fields.variables)
+        if plan.fields.batched or plan.field and plan.field.batched:
+            selection.batched = True
+        if plan.fields.mutates or plan.field and plan.field.mutation:
+            selection.mutates = True
+    if variables:
+        selection.variables = frozenset(variables)
+    return selection
+
+
+def bind_kwargs(kwargs):
+    return MappingProxyType(dict(kwargs)) if kwargs else EMPTY_KWARGS
+
+
+def variables_in(value):
+    if isinstance(value, Variable):
+        yield value.name
+    elif isinstance(value, (dict, MappingProxyType)):
+        for item in value.values():
+            yield from variables_in(item)
+    elif isinstance(value, list):
+        for item in value:
+            yield from variables_in(item)
+
+
+def bind_variables(selection, variables):
+    """Copy of `selection` with the `variables` replaced in its kwargs"""
+    if not selection.variables:
+        return selection
+    return make_selection([
+        plan._replace(
+            kwargs=bind_kwargs(replace_variables(plan.kwargs, variables)),
+            fields=bind_variables(plan.fields, variables),
+        )
+        for plan in selection
+    ], selection.path)
+
+
+def replace_variables(value, variables):
+    if isinstance(value, Variable):
+        try:
+            return variables[value.name]
+        except KeyError:
+            raise MissingVariable(value.name)
+    elif isinstance(value, (dict, MappingProxyType)):
+        return {
+            key: replace_variables(item, variables)
+            for key, item in value.items()
+        }
+    elif isinstance(value, list):
+        return [replace_variables(item, variables) for item in value]
+    return value
+
+
+def compile_query_text(schema, query, cache=None):
+    """Cached compilation of the text `query` against `schema`
+
+    `schema` is a tuple of (name, Node class) pairs, so it can be hashed. The
+    plan is stored with the parsed query in `cache` (a `ParseCache`).
+    """
+    document = (cache or parse_cache).document(query)
+    plan = document.plans.get(schema)
+    if plan is None:
+        plan = document.plans[schema] = compile_query(
+            dict(schema), document.ast
+        )
+    return plan
+
+
+def query_text(selection):
+    """Canonical text of `selection`, the same for the queries that only
+    differ in spacing, the order of the kwargs or how their values were
+    given (literals or variables, once bound)
+    """
+    parts = []
+    for plan in selection:
+        part = plan.name
+        if plan.kwargs:
+            part += '(%s)' % ', '.join(
+                f'{name}: {value_text(plan.kwargs[name])}'
+                for name in sorted(plan.kwargs)
+            )
+        if plan.fields:
+            part += ' {%s}' % query_text(plan.fields)
+        parts.append(part)
+    return ' '.join(parts)
+
+
+def value_text(value):
+    if isinstance(value, (dict, MappingProxyType)):
+        return '{%s}' % ', '.join(
+            f'{key!r}: {value_text(value[key])}' for key in sorted(value)
+        )
+    elif isinstance(value, (list, tuple)):
+        return '[%s]' % ', '.join(value_text(item) for item in value)
+    return repr(value)
+
+
+def nodes_in(selection):
+    """Node classes that serialize the items of `selection`"""
+    nodes = set()
+    for plan in selection:
+        if plan.node:
+            nodes.add(plan.node)
+        nodes.update(nodes_in(plan.fields))
+    return nodes
@@ -0,0 +1,160 @@
+"""Auditing of the SQL queries executed while solving queries with Django.
+
+`SQLAudit` is a `carbon14.tracing.Tracer` that captures the SQL executed
+inside `capture()` and attributes each statement to the path of the fields
+being solved when it ran, like `'authors.description'`. Statements with the
+same shape (the SQL with its lists of parameters collapsed) repeated in the
+same path are the mark of N+1 queries. With a `QueryBudget` the audit warns,
+or raises `TooManyQueries`, when the queries exceed it.
+"""
+import re
+import warnings
+from collections import Counter
+from contextlib import ExitStack, contextmanager
+from typing import NamedTuple, Optional
+
+from django.db import connections
+
+from .errors import TooManyQueries
+from .tracing import Tracer
+
+
+class QueryBudget(NamedTuple):
+    """Maximum SQL queries allowed while solving a query
+
+    - `max_queries`: in total.
+    - `max_queries_per_path`: attributed to each node or field path.
+    - `max_repeats`: of the same shape in the same path.
+
+    `action` is `'warn'` (a `QueryBudgetWarning`) or `'raise'`.
+    """
+    max_queries: Optional[int] = None
+    max_queries_per_path: Optional[int] = None
+    max_repeats: Optional[int] = None
+    action: str = 'warn'
+
+
+class QueryBudgetWarning(UserWarning):
+    pass
+
+
+class CapturedQuery(NamedTuple):
+    path: str
+    sql: str
+    shape: str
+
+
+PARAMETERS_REGEX = re.compile(r'\((?:\s*%s\s*,)*\s*%s\s*\)')
+LITERALS_REGEX = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+
+
+def shape_of(sql):
+    """`sql` without its literals and with its lists of parameters
+    collapsed, so the same statement for other rows has the same shape
+    """
+    sql = LITERALS_REGEX.sub('%s', sql)
+    return PARAMETERS_REGEX.sub('(%s...)', sql)
+
+
+class SQLAudit(Tracer):
+    """Tracer capturing the SQL queries executed by the connections inside
+    `capture()` with the path being solved, checked against `budget`
+
+    The spans are forwarded to `tracer`, if any.
+    """
+
+    def __init__(self, budget=None, tracer=None):
+        self.budget = budget
+        self.tracer = tracer
+        self.queries = []
+        self.paths = []
+
+    def start(self, kind, path):
+        self.paths.append(path)
+        if self.tracer is not None:
+            self.tracer.start(kind, path)
+
+    def end(self, kind, path, duration):
+        self.paths.pop()
+        if self.tracer is not None:
+            self.tracer.end(kind, path, duration)
+
+    @contextmanager
+    def capture(self):
+        """Capture the queries executed inside and then `check` them"""
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(self.execute))
+            yield self
+        self.check()
+
+    def execute(self, execute, sql, params, many, context):
+        path = self.paths[-1] if self.paths else ''
+        self.queries.append(CapturedQuery(path, sql, shape_of(sql)))
+        return execute(sql, params, many, context)
+
+    def per_path(self):
+        """{path: number of queries}"""
+        return Counter(query.path for query in self.queries)
+
+    def repeated(self):
+        """{(path, shape): times} of the queries executed more than once"""
+        shapes = Counter((query.path, query.shape) for query in self.queries)
+        return {key: times for key, times in shapes.items() if times > 1}
+
+    def problems(self):
+        """Descriptions of how the queries exceed the budget"""
+        budget = self.budget or QueryBudget()
+        problems = []
+        if (
+            budget.max_queries is not None and
+            len(self.queries) > budget.max_queries
+        ):
+            problems.append(
+                f'{len(self.queries)} queries, the maximum is '
+                f'{budget.max_queries}'
+            )
+        if budget.max_queries_per_path is not None:
+            for path, n in self.per_path().items():
+                if n > budget.max_queries_per_path:
+                    problems.append(
+                        f'{n} queries in "{path}", the maximum is '
+                        f'{budget.max_queries_per_path}'
+                    )
+        if budget.max_repeats is not None:
+            for (path, shape), times in self.repeated().items():
+                if times > budget.max_repeats:
+                    problems.append(
+                        f'{times} times in "{path}": {shape}'
+                    )
+        return problems
+
+    def check(self):
+        problems = self.problems()
+        if not problems:
+            return
+        error = TooManyQueries(problems)
+        if self.budget.action == 'raise':
+            raise error
+        warnings.warn(str(error), QueryBudgetWarning, stacklevel=3)
+
+
+@contextmanager
+def assert_queries(root_node, max_queries=None, max_queries_per_path=None,
+                   max_repeats=None):
+    """Assert that the queries solved by `root_node` inside don't exceed
+    the budget, raising `TooManyQueries` otherwise
+
+        with assert_queries(root_node, max_repeats=1):
+            root_node.query('authors { name books { title } }')
+    """
+    audit = SQLAudit(
+        QueryBudget(max_queries, max_queries_per_path, max_repeats, 'raise'),
+        tracer=root_node.tracer,
+    )
+    root_node.tracer = audit
+    try:
+        with audit.capture():
+            yield audit
+    finally:
+        root_node.tracer = audit.tracer
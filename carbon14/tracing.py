@@ -0,0 +1,98 @@
+"""Instrumentation of the executions of queries.
+
+A `Tracer` attached to a `RootNode` gets the start and the end of the spans
+of the work done to answer a query. Each span has a kind and the path of the
+fields it is about, like `'books.author.name'`:
+
+- `'parse'`: parsing and compiling the text of a query (path `''`).
+- `'solve'`: solving an entry of the root (path `'books'`).
+- `'filter'`: `Node.filter` of a collection (path of the collection).
+- `'resolve'`: `Field.resolve` of an item (path of the field).
+- `'related'`: serializing the value of a related field, including its
+  nested fields (path of the field).
+- `'encode'`: encoding the answer to JSON (path `''`).
+
+When no tracer is attached the only cost is checking that there is none.
+"""
+from threading import Lock
+from time import perf_counter
+
+
+class Tracer:
+    """Base of the tracers, that ignore the spans"""
+
+    def start(self, kind, path):
+        pass
+
+    def end(self, kind, path, duration):
+        """`duration` is the time spent in the span in seconds"""
+
+    def span(self, kind, path):
+        return Span(self, kind, path)
+
+
+class Span:
+    """Context manager reporting its start and end to a tracer"""
+    __slots__ = ('tracer', 'kind', 'path', 'started')
+
+    def __init__(self, tracer, kind, path):
+        self.tracer = tracer
+        self.kind = kind
+        self.path = path
+
+    def __enter__(self):
+        self.tracer.start(self.kind, self.path)
+        self.started = perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        duration = perf_counter() - self.started
+        self.tracer.end(self.kind, self.path, duration)
+
+
+class Timing:
+    """Aggregated durations of the spans with the same kind and path"""
+    __slots__ = ('count', 'total', 'max')
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def __repr__(self):
+        return (
+            f'Timing(count={self.count}, total={self.total:.6f}, '
+            f'max={self.max:.6f})'
+        )
+
+
+class Collector(Tracer):
+    """Tracer aggregating the count, total and max time of the spans
+
+    `timings` is `{(kind, path): Timing}`. It is thread safe, so it can be
+    shared by the executions of several requests.
+    """
+
+    def __init__(self):
+        self.timings = {}
+        self.lock = Lock()
+
+    def end(self, kind, path, duration):
+        with self.lock:
+            timing = self.timings.get((kind, path))
+            if timing is None:
+                timing = self.timings[kind, path] = Timing()
+            timing.count += 1
+            timing.total += duration
+            if duration > timing.max:
+                timing.max = duration
+
+    def report(self):
+        """(kind, path, timing) sorted by the total time, slowest first"""
+        with self.lock:
+            rows = [(*key, t) for key, t in self.timings.items()]
+        return sorted(rows, key=lambda row: row[2].total, reverse=True)
+
+    def clear(self):
+        with self.lock:
+            self.timings.clear()
@@ -29,3 +29,8 @@ def get_first_of(obj, name):
     if isinstance(obj, dict):
         return obj.get(name)
     return getattr(obj, name, None)
+
+
+def pk_of(obj):
+    pk = get_first_of(obj, 'pk')
+    return get_first_of(obj, 'id') if pk is None else pk
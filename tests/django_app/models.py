@@ -0,0 +1,17 @@
+from django.db import models
+
+
+class Author(models.Model):
+    name = models.CharField(max_length=100)
+    biography = models.TextField(default='')
+    is_alive = models.BooleanField(default=True)
+    photo = models.FileField(default='', blank=True)
+
+
+class Book(models.Model):
+    title = models.CharField(max_length=100)
+    n_pages = models.IntegerField(default=0)
+    content = models.TextField(default='')
+    author = models.ForeignKey(
+        Author, related_name='books', on_delete=models.CASCADE
+    )
@@ -0,0 +1,743 @@
+from unittest.mock import Mock, patch
+from pytest import importorskip, raises, warns
+
+importorskip('django')
+importorskip('rest_framework')
+
+import django  # noqa: E402
+from django.conf import settings  # noqa: E402
+
+if not settings.configured:
+    settings.configure(
+        INSTALLED_APPS=[
+            'django.contrib.contenttypes',
+            'django.contrib.auth',
+            'django_app',
+        ],
+        DATABASES={
+            'default': {
+                'ENGINE': 'django.db.backends.sqlite3',
+                'NAME': ':memory:',
+            },
+            'replica': {
+                'ENGINE': 'django.db.backends.sqlite3',
+                'NAME': ':memory:',
+            },
+        },
+        CACHES={
+            'default': {
+                'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            },
+        },
+    )
+    django.setup()
+
+from asgiref.sync import async_to_sync  # noqa: E402
+from django.core.cache import cache  # noqa: E402
+from django.core.management import call_command  # noqa: E402
+from django.db import connection, connections, router, \
+    transaction  # noqa: E402
+from django.db.models import Count, Exists, OuterRef, Prefetch, \
+    Sum  # noqa: E402
+from django.test import TestCase  # noqa: E402
+from django.test.utils import CaptureQueriesContext  # noqa: E402
+from rest_framework.test import APIRequestFactory  # noqa: E402
+
+from carbon14.cache import FieldCache  # noqa: E402
+from carbon14.codegen import generate, shape_of  # noqa: E402
+from carbon14.django import Node, Field, A, Many, Annotation, \
+    GraphQLView, DjangoCacheBackend, ResponseCache  # noqa: E402
+from carbon14 import json, neonode  # noqa: E402
+from carbon14.errors import InvalidCursor, TooManyQueries  # noqa: E402
+from carbon14.neonode import RootNode  # noqa: E402
+from carbon14.persisted import PersistedQueries, query_id  # noqa: E402
+from carbon14.sql import QueryBudget, QueryBudgetWarning, \
+    assert_queries  # noqa: E402
+from django_app.models import Author, Book  # noqa: E402
+
+call_command('migrate', run_syncdb=True, verbosity=0)
+call_command('migrate', run_syncdb=True, verbosity=0, database='replica')
+
+descriptions = []
+
+
+class Books(Node):
+    class Meta(Node.Meta):
+        name = 'books'
+        source = Book.objects.all()
+        fields = ('id', 'title', 'n_pages')
+        is_public = True
+        cursor_ordering = ('-n_pages',)
+
+    author = A('authors')
+    has_prequel = Annotation(Exists(Book.objects.filter(
+        author=OuterRef('author'), id__lt=OuterRef('id'),
+    )))
+
+    @Field(int)
+    def n_words(self, book, **kwargs):
+        return len(book.content.split())
+
+    @Field(str, select_related='author', columns='title')
+    def byline(self, book, **kwargs):
+        return f'{book.title} by {book.author.name}'
+
+    @Field(str, mutation=True, columns='title')
+    def reverse_title(self, book, **kwargs):
+        book.title = book.title[::-1]
+        book.save()
+        return book.title
+
+
+class Authors(Node):
+    class Meta(Node.Meta):
+        name = 'authors'
+        source = Author.objects.all()
+        fields = ('id', 'name', 'photo')
+        is_public = True
+        optimize = {'titles': 'books'}
+
+    books = Many('books')
+    n_books = Annotation(Count('books'))
+    n_pages = Annotation(Sum('books__n_pages'))
+
+    @Field(
+        str,
+        cache=FieldCache(backend=DjangoCacheBackend()),
+        columns=('name',),
+    )
+    def description(self, author, **kwargs):
+        descriptions.append(author.id)
+        return f'{author.name} wrote {author.books.count()} books'
+
+    @Field(str)
+    def titles(self, author, **kwargs):
+        return ', '.join(book.title for book in author.books.all())
+
+    @Field(str, prefetch_related=Prefetch(
+        'books', Book.objects.order_by('-title'), to_attr='books_by_title',
+    ))
+    def last_title(self, author, **kwargs):
+        return author.books_by_title[0].title
+
+
+class TestDjangoNodes(TestCase):
+    databases = {'default', 'replica'}
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.grace = Author.objects.create(name='Grace')
+        cls.john = Author.objects.create(name='John')
+        for i, author in enumerate([cls.grace, cls.grace, cls.john]):
+            Book.objects.create(title=f'Book {i}', n_pages=i, author=author)
+
+    def setUp(self):
+        cache.clear()
+        descriptions.clear()
+        self.root_node = RootNode([Books, Authors])
+
+    def query(self, query, **kwargs):
+        return self.root_node.query(query, **kwargs)
+
+    def test_nested_query(self):
+        with self.assertNumQueries(2):
+            data = self.query('authors { name books { title } }')
+        assert data == {
+            'authors': [
+                {
+                    'name': 'Grace',
+                    'books': [{'title': 'Book 0'}, {'title': 'Book 1'}],
+                },
+                {'name': 'John', 'books': [{'title': 'Book 2'}]},
+            ]
+        }
+
+    def test_only_the_columns_needed_are_loaded(self):
+        with CaptureQueriesContext(connection) as context:
+            data = self.query('books { title author { name } }')
+        [sql] = [query['sql'] for query in context.captured_queries]
+        assert '"title"' in sql and '"name"' in sql
+        assert '"content"' not in sql and '"biography"' not in sql
+        assert data['books'][2] == {'title': 'Book 2', 'author': {
+            'name': 'John',
+        }}
+
+        with CaptureQueriesContext(connection) as context:
+            data = self.query("""
+                authors { description books (after: null) { n_pages } }
+            """)
+        authors_sql, books_sql = [
+            query['sql'] for query in context.captured_queries
+        ]
+        assert '"biography"' not in authors_sql
+        assert '"content"' not in books_sql and '"title"' not in books_sql
+        assert data['authors'][1]['books']['items'] == [{'n_pages': 2}]
+
+        # the columns used by resolvers are unknown unless declared
+        with CaptureQueriesContext(connection) as context:
+            data = self.query('books { n_words }')
+        assert '"content"' in context.captured_queries[0]['sql']
+
+    def test_plain_selections_skip_the_model_instances(self):
+        no_instances = patch.multiple(
+            Book, from_db=Mock(side_effect=AssertionError),
+        )
+        with no_instances, self.assertNumQueries(1):
+            data = self.query('books (limit: 2) { id title author { name } }')
+        assert data == {'books': [
+            {'id': 1, 'title': 'Book 0', 'author': {'name': 'Grace'}},
+            {'id': 2, 'title': 'Book 1', 'author': {'name': 'Grace'}},
+        ]}
+
+        # custom resolvers need the instances
+        with no_instances, raises(AssertionError):
+            self.query('books { title n_words }')
+        assert self.query('books { title n_words }')['books'][0] == {
+            'title': 'Book 0', 'n_words': 0,
+        }
+
+        # and so do the columns read through descriptors, like files
+        self.grace.photo = 'grace.png'
+        self.grace.save()
+        data = self.query('authors { name photo }')
+        assert json.loads(json.dumps(data))['authors'][0] == {
+            'name': 'Grace', 'photo': self.grace.photo.url,
+        }
+
+    def test_columns_are_plain_fields(self):
+        fields = Books._fields
+        assert fields['id'].is_plain and fields['title'].is_plain
+        assert not fields['n_words'].is_plain
+        assert not fields['author'].is_plain
+        assert not Authors._fields['books'].is_plain
+        assert not Authors._fields['description'].is_plain
+        assert not Authors._fields['n_books'].is_plain
+        assert 'resolve' not in generate(shape_of(
+            self.root_node.compile('books { id title }')[0].fields
+        ))
+
+        class CompiledBooks(Books):
+            class Meta(Books.Meta):
+                compile_serializers = True
+
+        query = 'books { id title n_words author { name } }'
+        root_node = RootNode([CompiledBooks, Authors])
+        assert root_node.query(query) == self.query(query)
+
+    def test_nested_limit_and_offset_are_solved_by_the_database(self):
+        Book.objects.create(title='Book 3', n_pages=3, author=self.grace)
+        with CaptureQueriesContext(connection) as context:
+            data = self.query("""
+                authors { name books (limit: 2, offset: 1) { title } }
+            """)
+        assert data == {'authors': [
+            {'name': 'Grace', 'books': [
+                {'title': 'Book 1'}, {'title': 'Book 3'},
+            ]},
+            {'name': 'John', 'books': []},
+        ]}
+        authors_sql, books_sql = [
+            query['sql'] for query in context.captured_queries
+        ]
+        assert 'ROW_NUMBER() OVER (PARTITION BY' in books_sql
+
+        data = self.query('authors { books (limit: 1) { title } }')
+        assert data['authors'] == [
+            {'books': [{'title': 'Book 0'}]}, {'books': [{'title': 'Book 2'}]},
+        ]
+
+    def test_aggregate_fields_are_annotated(self):
+        with self.assertNumQueries(1):
+            data = self.query('authors { name n_books n_pages }')
+        assert data == {'authors': [
+            {'name': 'Grace', 'n_books': 2, 'n_pages': 1},
+            {'name': 'John', 'n_books': 1, 'n_pages': 2},
+        ]}
+
+        with self.assertNumQueries(2):
+            data = self.query("""
+                authors { n_books books (limit: 1, offset: 1) {
+                    title has_prequel
+                } }
+            """)
+        assert data == {'authors': [
+            {'n_books': 2, 'books': [
+                {'title': 'Book 1', 'has_prequel': True},
+            ]},
+            {'n_books': 1, 'books': []},
+        ]}
+
+        # the related items of A fields are annotated one by one
+        with self.assertNumQueries(3):
+            data = self.query('books { author { name n_books } }')
+        assert data['books'][2] == {'author': {'name': 'John', 'n_books': 1}}
+
+    def test_async_queries_read_the_database_in_a_thread(self):
+        query = 'authors { name n_books books { title author { name } } }'
+        data = async_to_sync(self.root_node.aquery)(query)
+        assert data == self.query(query)
+
+        query = """
+            authors (limit: 1, after: null) {
+                name books (limit: 1, after: null) { title }
+            }
+        """
+        data = async_to_sync(self.root_node.aquery)(query)
+        assert data == self.query(query)
+        assert data['authors']['page']['has_next']
+        assert data['authors']['items'][0]['books']['page']['has_next']
+
+    def test_columnar_pages(self):
+        data = self.query("""
+            authors { name books (limit: 1, after: null) { title } }
+        """, format='columnar')
+        books = data['authors']['books']
+        assert books['title'] == ['Book 1', 'Book 2']
+        assert books['_parent'] == [0, 1]
+        first, second = books['_pages']
+        assert first['has_next'] and not second['has_next']
+        assert first['end_cursor'] != second['end_cursor']
+
+    def test_optimization_hints(self):
+        with self.assertNumQueries(2):
+            data = self.query('authors { titles }')
+        assert data['authors'][0] == {'titles': 'Book 0, Book 1'}
+
+        with self.assertNumQueries(1):
+            data = self.query('books { byline }')
+        assert data['books'][2] == {'byline': 'Book 2 by John'}
+
+        # at every level, and apart from the items of the Many fields
+        with self.assertNumQueries(3):
+            data = self.query("""
+                books { author { titles books { byline } } }
+            """)
+        assert data['books'][2]['author'] == {
+            'titles': 'Book 2', 'books': [{'byline': 'Book 2 by John'}],
+        }
+        with self.assertNumQueries(3):
+            data = self.query('authors { books (limit: 1) { title } titles }')
+        assert data['authors'][0] == {
+            'books': [{'title': 'Book 0'}], 'titles': 'Book 0, Book 1',
+        }
+        data = self.query('authors { books (offset: 1) { title } titles }')
+        assert data['authors'][0]['books'] == [{'title': 'Book 1'}]
+        data = self.query("""
+            authors { titles books (limit: 1, after: null) { title } }
+        """)
+        assert data['authors'][0]['titles'] == 'Book 0, Book 1'
+        assert data['authors'][0]['books']['items'] == [{'title': 'Book 1'}]
+        assert data['authors'][0]['books']['page']['has_next']
+
+    def test_prefetch_objects_as_hints(self):
+        with self.assertNumQueries(2):
+            data = self.query('authors { last_title }')
+        assert data['authors'][0] == {'last_title': 'Book 1'}
+        with self.assertNumQueries(2):
+            data = self.query('books { author { last_title } }')
+        assert data['books'][0] == {'author': {'last_title': 'Book 1'}}
+        with self.assertNumQueries(4):
+            data = self.query(
+                'authors { last_title titles books (limit: 1) { title } }'
+            )
+        assert data['authors'][0] == {
+            'last_title': 'Book 1',
+            'titles': 'Book 0, Book 1',
+            'books': [{'title': 'Book 0'}],
+        }
+
+    def test_cursor_pagination(self):
+        with self.assertNumQueries(1):
+            data = self.query('authors (limit: 1, after: null) { name }')
+        page = data['authors']['page']
+        assert data['authors']['items'] == [{'name': 'Grace'}]
+        assert page['has_next'] and not page['has_previous']
+
+        data = self.query(
+            'authors (limit: 1, after: $after) { name }',
+            variables={'after': page['end_cursor']},
+        )
+        page = data['authors']['page']
+        assert data['authors']['items'] == [{'name': 'John'}]
+        assert not page['has_next'] and page['has_previous']
+
+        data = self.query(
+            'authors (limit: 1, before: $before) { name }',
+            variables={'before': page['start_cursor']},
+        )
+        assert data['authors']['items'] == [{'name': 'Grace'}]
+        assert data['authors']['page']['has_next']
+
+        # ordered by Meta.cursor_ordering, the pages are in the same order
+        data = self.query('books (before: null) { title }')
+        assert data['books']['items'] == [
+            {'title': 'Book 2'}, {'title': 'Book 1'}, {'title': 'Book 0'},
+        ]
+        with raises(InvalidCursor):
+            self.query('books (after: "nope") { title }')
+
+    def test_nested_cursor_pagination(self):
+        with self.assertNumQueries(2):
+            data = self.query("""
+                authors { name books (limit: 1, after: null) { title } }
+            """)
+        grace, john = data['authors']
+        assert grace['books']['items'] == [{'title': 'Book 1'}]
+        assert grace['books']['page']['has_next']
+        assert john['books']['items'] == [{'title': 'Book 2'}]
+        assert not john['books']['page']['has_next']
+
+        data = self.query(
+            'authors { books (limit: 1, after: $after) { title } }',
+            variables={'after': grace['books']['page']['end_cursor']},
+        )
+        grace, john = data['authors']
+        assert grace['books']['items'] == [{'title': 'Book 0'}]
+        assert not grace['books']['page']['has_next']
+        assert john['books']['items'] == []
+
+    def test_batched_queries_share_the_execution(self):
+        view = GraphQLView.as_view(nodes=[Books, Authors])
+        request = APIRequestFactory().post('/graphql/', [
+            {'query': 'authors { name description }'},
+            {'query': 'books (ids: $ids) { title }', 'variables': {
+                'ids': [self.john.books.get().id],
+            }},
+            {'query': 'publishers { name }'},
+            {'query': 'authors { description }'},
+            'authors { name }',
+        ], format='json')
+        with patch.object(neonode, 'Execution', wraps=neonode.Execution) \
+                as execution:
+            response = view(request)
+        assert execution.call_count == 1
+        assert response.status_code == 200
+        first, second, missing, third, wrong = json.loads(response.content)
+        assert first['data']['authors'][1] == {
+            'name': 'John', 'description': 'John wrote 1 books',
+        }
+        assert second == {'data': {'books': [{'title': 'Book 2'}]}}
+        assert 'publishers' in missing['details']
+        assert third['data']['authors'][0] == {
+            'description': 'Grace wrote 2 books',
+        }
+        assert wrong == {'details': 'Queries should be JSON objects.'}
+
+        request = APIRequestFactory().post(
+            '/graphql/', {'query': 'authors { name }'}, format='json',
+        )
+        assert view(request).status_code == 400
+
+    def test_batched_queries_reuse_the_fetched_rows(self):
+        view = GraphQLView.as_view(nodes=[Books, Authors])
+        query = 'books (ids: $ids) { title }'
+        variables = {'ids': [self.john.books.get().id]}
+        request = APIRequestFactory().post('/graphql/', [
+            {'query': query, 'variables': variables},
+            {'query': query, 'variables': variables},
+            {'query': 'books (ids: $ids) { reverse_title }',
+             'variables': variables},
+            {'query': query, 'variables': variables},
+        ], format='json')
+        # the second query is answered with the rows of the first one, and
+        # the ones after the mutation fetch them again
+        with self.assertNumQueries(1 + 4 + 1):
+            response = view(request)
+        first, second, mutation, third = json.loads(response.content)
+        assert first == second == {'data': {'books': [{'title': 'Book 2'}]}}
+        assert third == {'data': {'books': [{'title': '2 kooB'}]}}
+
+    def test_n_plus_one_queries_are_detected(self):
+        with assert_queries(self.root_node, max_repeats=1) as audit:
+            self.query('authors { name books { title author { name } } }')
+        assert audit.per_path() == {'authors': 2}
+
+        with raises(TooManyQueries) as error:
+            with assert_queries(self.root_node, max_repeats=1) as audit:
+                self.query('authors { name description }')
+        assert audit.per_path() == {'authors': 1, 'authors.description': 2}
+        assert '2 times in "authors.description"' in str(error.value)
+        assert self.root_node.tracer is None
+
+        with raises(TooManyQueries, match='3 queries, the maximum is 2'):
+            with assert_queries(self.root_node, max_queries=2):
+                for _ in range(3):
+                    self.query('authors { name }')
+
+    def test_view_query_budget(self):
+        request = APIRequestFactory().get(
+            '/graphql/',
+            {'query': 'authors { description }'},
+            HTTP_ACCEPT='application/json',
+        )
+        view = GraphQLView.as_view(
+            nodes=[Books, Authors], query_budget=QueryBudget(max_repeats=1),
+        )
+        with warns(QueryBudgetWarning, match='authors.description'):
+            assert view(request).status_code == 200
+
+        cache.clear()
+        view = GraphQLView.as_view(
+            nodes=[Books, Authors],
+            query_budget=QueryBudget(max_queries_per_path=1, action='raise'),
+        )
+        response = view(request)
+        assert response.status_code == 400
+        assert b'2 queries in \\"authors.description\\"' in response.content
+
+    def test_streamed_answers_are_solved_while_sent(self):
+        view = GraphQLView.as_view(nodes=[Books, Authors], streaming=True)
+        request = APIRequestFactory().get(
+            '/graphql/',
+            {'query': 'authors { name books { title } }'},
+            HTTP_ACCEPT='application/json',
+        )
+        with patch.object(Node.Meta, 'chunk_size', 1), \
+                self.assertNumQueries(0):
+            response = view(request)
+        assert response.streaming
+        # the authors are read one at a time, each prefetching its books
+        with self.assertNumQueries(3):
+            content = b''.join(response.streaming_content)
+        assert json.loads(content) == self.query(
+            'authors { name books { title } }'
+        )
+
+        request = APIRequestFactory().get(
+            '/graphql/',
+            {'query': 'authors { name titles }'},
+            HTTP_ACCEPT='application/json',
+        )
+        response = view(request)
+        assert json.loads(b''.join(response.streaming_content)) == {
+            'authors': [
+                {'name': 'Grace', 'titles': 'Book 0, Book 1'},
+                {'name': 'John', 'titles': 'Book 2'},
+            ],
+        }
+
+    def test_persisted_queries(self):
+        query = 'books (ids: $ids) { title }'
+        registry = PersistedQueries.from_mapping({'books_by_id': query})
+        factory = APIRequestFactory()
+        variables = json.dumps({'ids': [self.john.books.get().id]})
+
+        def get(view, **params):
+            return view(factory.get(
+                '/graphql/', params, HTTP_ACCEPT='application/json',
+            ))
+
+        view = GraphQLView.as_view(
+            nodes=[Books, Authors],
+            persisted_queries=registry,
+            allow_ad_hoc_queries=False,
+        )
+        for key in ('books_by_id', query_id(query)):
+            response = get(view, id=key, variables=variables)
+            assert response.status_code == 200
+            assert json.loads(response.content) == {
+                'books': [{'title': 'Book 2'}],
+            }
+        response = get(view, id='missing')
+        assert response.status_code == 400
+        assert 'id "missing"' in json.loads(response.content)['details']
+        response = get(view, query='books { title }')
+        assert response.status_code == 400
+        assert b'Only persisted queries' in response.content
+
+        # without persisted queries the id can't be ignored
+        view = GraphQLView.as_view(nodes=[Books, Authors])
+        response = get(view, id='books_by_id', variables=variables)
+        assert response.status_code == 400
+        assert b'no persisted query' in response.content
+
+    def test_etag_and_not_modified(self):
+        view = GraphQLView.as_view(nodes=[Books, Authors])
+        factory = APIRequestFactory()
+        response = view(factory.get(
+            '/graphql/', {'query': 'authors { name }'},
+            HTTP_ACCEPT='application/json',
+        ))
+        assert response.status_code == 200
+        etag = response['ETag']
+
+        response = view(factory.get(
+            '/graphql/', {'query': 'authors { name }'},
+            HTTP_ACCEPT='application/json', HTTP_IF_NONE_MATCH=etag,
+        ))
+        assert response.status_code == 304
+        assert response['ETag'] == etag
+        assert response.content == b''
+
+        response = view(factory.get(
+            '/graphql/', {'query': 'authors { id name }'},
+            HTTP_ACCEPT='application/json', HTTP_IF_NONE_MATCH=etag,
+        ))
+        assert response.status_code == 200
+        assert response['ETag'] != etag
+
+    def test_responses_are_cached_until_the_models_change(self):
+        view = GraphQLView.as_view(
+            nodes=[Books, Authors], response_cache=ResponseCache(),
+        )
+        factory = APIRequestFactory()
+
+        def get(query, **params):
+            return view(factory.get(
+                '/graphql/', {'query': query, **params},
+                HTTP_ACCEPT='application/json',
+            ))
+
+        query = 'books (limit: 1, offset: $n) { title author { name } }'
+        response = get(query, variables=json.dumps({'n': 1}))
+        assert json.loads(response.content) == {
+            'books': [{'title': 'Book 1', 'author': {'name': 'Grace'}}],
+        }
+        with self.assertNumQueries(0):
+            cached = get(
+                'books(offset: 1, limit: 1) {title author {name}}'
+            )
+        assert cached.content == response.content
+        assert cached['ETag'] == response['ETag']
+        with self.assertNumQueries(1):
+            get(query, variables=json.dumps({'n': 2}))
+
+        self.grace.name = 'Grace H.'
+        self.grace.save()
+        with self.assertNumQueries(1):
+            response = get(query, variables=json.dumps({'n': 1}))
+        assert b'Grace H.' in response.content
+
+        # mutations are never cached
+        variables = json.dumps({'ids': [self.john.books.get().id]})
+        for title in ('2 kooB', 'Book 2'):
+            # in a savepoint of the transaction of the test
+            with self.assertNumQueries(4):
+                response = get(
+                    'books (ids: $ids) { reverse_title }', variables=variables,
+                )
+            assert json.loads(response.content) == {
+                'books': [{'reverse_title': title}],
+            }
+
+    def test_response_cache_follows_the_models_of_the_fields(self):
+        view = GraphQLView.as_view(
+            nodes=[Books, Authors], response_cache=ResponseCache(),
+        )
+
+        def get(query):
+            response = view(APIRequestFactory().get(
+                '/graphql/', {'query': query}, HTTP_ACCEPT='application/json',
+            ))
+            return json.loads(response.content)['authors'][1]
+
+        assert get('authors { n_books }') == {'n_books': 1}
+        assert get('authors { titles }') == {'titles': 'Book 2'}
+        Book.objects.create(title='Book 3', n_pages=3, author=self.john)
+        assert get('authors { n_books }') == {'n_books': 2}
+        assert get('authors { titles }') == {'titles': 'Book 2, Book 3'}
+
+    def test_response_cache_scope(self):
+        class PrivateAuthors(Authors):
+            class Meta(Authors.Meta):
+                is_public = False
+
+        root_node = RootNode([Books, PrivateAuthors])
+        response_cache = ResponseCache()
+        books = root_node.compile('books { title }')
+        authors = root_node.compile('books { author { name } }')
+
+        def key(query, pk):
+            return response_cache.key(Mock(user=Mock(pk=pk)), query, 'nested')
+
+        assert key(books, 1) == key(books, 2)
+        assert key(authors, 1) != key(authors, 2)
+        assert key(authors, 1) == key(authors, 1)
+        assert key(books, 1) != key(authors, 1)
+
+        # other node classes with the same names
+        class FirstBooks(Books):
+            def filter(self, _source, **kwargs):
+                return _source.filter(title='Book 0')
+
+        other = RootNode([FirstBooks, Authors]).compile('books { title }')
+        assert key(other, 1) != key(books, 1)
+
+        # answers are not valid again when the versions are evicted
+        before = key(books, 1)
+        Book.objects.get(title='Book 0').save()
+        cache.clear()
+        assert key(books, 1) != before
+
+    def test_read_only_queries_use_the_replica(self):
+        ada = Author.objects.using('replica').create(name='Ada')
+        Book.objects.using('replica').create(
+            title='Notes', n_pages=10, author=ada,
+        )
+        view = GraphQLView.as_view(nodes=[Books, Authors], replica='replica')
+        query = 'authors { name n_pages books { title author { name } } }'
+        assert self.root_node.is_read_only(query)
+        with self.assertNumQueries(0):
+            response = view(APIRequestFactory().get(
+                '/graphql/', {'query': query}, HTTP_ACCEPT='application/json',
+            ))
+        assert json.loads(response.content) == {'authors': [{
+            'name': 'Ada',
+            'n_pages': 10,
+            'books': [{'title': 'Notes', 'author': {'name': 'Ada'}}],
+        }]}
+
+        query = 'books (ids: $ids) { reverse_title }'
+        assert not self.root_node.is_read_only(query)
+        request = APIRequestFactory().post('/graphql/', [
+            {'query': 'books { title }'},
+            {'query': query, 'variables': {'ids': [self.john.books.get().id]}},
+        ], format='json')
+        replica = CaptureQueriesContext(connections['replica'])
+        with replica, patch.object(
+            transaction, 'atomic', wraps=transaction.atomic,
+        ) as atomic:
+            response = view(request)
+        assert len(replica) == 1
+        atomic.assert_called_once_with(using='default')
+        read, mutation = json.loads(response.content)
+        assert read == {'data': {'books': [{'title': 'Notes'}]}}
+        assert mutation == {'data': {'books': [{'reverse_title': '2 kooB'}]}}
+        assert self.john.books.get().title == '2 kooB'
+
+        # even when the router sends all the reads to the replica
+        query = 'authors { name books { reverse_title } }'
+        replica = CaptureQueriesContext(connections['replica'])
+        with replica, patch.object(
+            router, 'db_for_read', return_value='replica',
+        ):
+            response = view(APIRequestFactory().get(
+                '/graphql/', {'query': query}, HTTP_ACCEPT='application/json',
+            ))
+        assert len(replica) == 0
+        assert json.loads(response.content)['authors'][1] == {
+            'name': 'John', 'books': [{'reverse_title': 'Book 2'}],
+        }
+
+    def test_cached_fields_are_invalidated_when_saved(self):
+        query = 'authors { description }'
+        expected = {
+            'authors': [
+                {'description': 'Grace wrote 2 books'},
+                {'description': 'John wrote 1 books'},
+            ]
+        }
+        assert self.query(query) == expected
+        with self.assertNumQueries(1):
+            assert self.query(query) == expected
+        assert descriptions == [self.grace.id, self.john.id]
+
+        self.john.name = 'Johnny'
+        self.john.save()
+        data = self.query(query)
+        assert data['authors'][1] == {'description': 'Johnny wrote 1 books'}
+        assert descriptions == [self.grace.id, self.john.id, self.john.id]
+
+        self.grace.delete()
+        assert cache.get(f'carbon14:authors:description:{self.grace.id}') \
+            is None
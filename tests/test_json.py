@@ -0,0 +1,28 @@
+from pytest import importorskip
+
+importorskip('django')
+
+from carbon14 import json  # noqa: E402
+
+
+def test_iterdumps_encodes_the_same_as_dumps():
+    def books():
+        yield {'id': 1, 'authors': (a for a in [{'id': 3}])}
+        yield {'id': 2, 'authors': []}
+
+    def data():
+        return {
+            'books': books(),
+            'authors': [{'id': 3, 'tags': {'a', 'b'} - {'b'}}],
+            'counts': {1: 2, 'x': [1.5, None]},
+            'empty': (),
+            'total': 2,
+        }
+
+    chunks = list(json.iterdumps(data(), chunk_size=1))
+    assert len(chunks) > 10
+    assert b''.join(chunks).decode() == json.dumps(data())
+
+    chunks = list(json.iterdumps(data()))
+    assert len(chunks) == 1
+    assert chunks[0].decode() == json.dumps(data())
@@ -1,4 +1,6 @@
 
+from pytest import raises
+
 from carbon14 import graphql
 from carbon14.graphql import Token
 from carbon14.errors import TokenizerError, LexicalError
@@ -173,3 +175,88 @@ def test_parser_with_list_as_parameter_value():
             'fields': {}
         }
     }
+
+
+def test_parser_decodes_values_inline():
+    query = r"""coco (a: 1.5, b: -2e2, c: 0, d: "té\n", e: {"k\"": nullable})
+        { nullable }"""
+    try:
+        graphql.parse(query)
+    except LexicalError as e:
+        assert str(e) == 'Unexpected "nullable" expecting ' \
+            'STRING, NUMBER, BOOL, NULL, VARIABLE at 1:52'
+    else:
+        assert False, "No LexicalError found :'("
+
+    result = graphql.parse(query.replace(': nullable', ': null'))
+    assert result == {
+        'coco': {
+            'kwargs': {
+                'a': 1.5,
+                'b': -200.0,
+                'c': 0,
+                'd': 'té\n',
+                'e': {'k"': None},
+            },
+            'fields': {'nullable': {'kwargs': {}, 'fields': {}}},
+        }
+    }
+
+
+def test_parser_with_unterminated_string():
+    query = """
+        coco (a: "asd) { id }
+    """
+    try:
+        graphql.parse(query)
+    except TokenizerError as e:
+        assert str(e) == 'Syntax error: """ unexpected at 2:18'
+    else:
+        assert False, "No TokenizerError found"
+
+
+def test_parsed_queries_are_immutable_and_shared():
+    query = 'coco (ids: [1, 2], by: {a: 1}) { id }'
+    result = graphql.parse(query)
+    assert graphql.parse(query) is result
+    with raises(TypeError):
+        result['coco']['fields'] = {}
+    with raises(TypeError):
+        result['coco']['kwargs']['ids'].append(3)
+    with raises(TypeError):
+        result['coco']['kwargs']['by'].update(b=2)
+    assert result['coco']['kwargs'].copy() == {'ids': [1, 2], 'by': {'a': 1}}
+
+
+def test_parse_cache_statistics_and_eviction():
+    cache = graphql.ParseCache(max_entries=2, max_bytes=4000)
+    assert cache.parse('a') is cache.parse('a')
+    cache.parse('b')
+    cache.parse('c')
+    assert cache.stats() == {
+        'hits': 1,
+        'misses': 3,
+        'evictions': 1,
+        'entries': 2,
+        'bytes': cache.bytes,
+    }
+    assert 0 < cache.bytes <= 4000
+
+    big_query = 'a (ids: [%s])' % ', '.join(str(i) for i in range(1000))
+    assert cache.parse(big_query)['a']['kwargs']['ids'][-1] == 999
+    assert cache.stats()['entries'] == 2  # too big to be cached
+
+    cache.parse('x (ids: [%s])' % ', '.join(str(i) for i in range(50)))
+    assert cache.stats()['evictions'] == 2
+    assert cache.bytes <= 4000
+
+
+def test_parser_with_variables():
+    result = graphql.parse('coco (a: $first, b: [1, $second_2]) { id }')
+    assert result['coco']['kwargs'] == {
+        'a': graphql.Variable('first'),
+        'b': [1, graphql.Variable('second_2')],
+    }
+
+    with raises(TokenizerError):
+        graphql.parse('coco (a: $ first)')
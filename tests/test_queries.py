@@ -1,11 +1,19 @@
+import asyncio
 from types import GeneratorType
-from pytest import raises
+from pytest import raises, importorskip
 from pprint import pprint
 from unittest import TestCase
+from unittest.mock import patch
 
 from carbon14 import graphql
-from carbon14.neonode import RootNode, Node, Field
-from carbon14.errors import MissingNode, MissingFields
+from carbon14.neonode import RootNode, Node, Field, Execution
+from carbon14.plan import Selection
+from carbon14.cache import FieldCache
+from carbon14.cost import Budget, Cost, analyze
+from carbon14.errors import MissingNode, MissingFields, MissingVariable, \
+    UnknownQuery, QueryTooExpensive, UnknownFormat
+from carbon14.persisted import PersistedQueries, query_id
+from carbon14.tracing import Tracer, Collector
 # from carbon14.schema import ValidationError
 
 # Models
@@ -71,13 +79,19 @@ class TestQueries(TestCase):
                     if title_contains in book.title
                 ]
 
-            @Field('authors')
+            @Field('authors', many=False)
             def author(self, book, **kwargs):
                 for author in AUTHORS:
                     if author.id == book.author_id:
                         return author
 
-            @Field('books')
+            @Field.batch('authors', many=False)
+            def writer(self, books, **kwargs):
+                batches.append(('writer', [book.id for book in books]))
+                authors = {author.id: author for author in AUTHORS}
+                return [authors.get(book.author_id) for book in books]
+
+            @Field('books', mutation=True)
             def change_title(self, instance, title: str):
                 instance.title = title
                 return instance
@@ -86,6 +100,8 @@ class TestQueries(TestCase):
             class Meta(Node.Meta):
                 name = 'authors'
                 source = AUTHORS
+                estimated_rows = 50
+                fan_out = {'books': 20}
 
             id = Field(int)
             name = Field(str)
@@ -93,6 +109,23 @@ class TestQueries(TestCase):
             books = Field('books')
             kill = Field('authors')
 
+            @Field(str, cache=FieldCache(ttl=60))
+            def summary(self, author, long=False, **kwargs):
+                calls.append(('summary', author.id, long))
+                return f'{author.name}: {len(author.books)} books'
+
+            @Field(str)
+            def signature(self, author, **kwargs):
+                calls.append(('signature', author.id))
+                return author.name.upper()
+
+            @Field.batch(int)
+            def n_books(self, authors, **kwargs):
+                batches.append(('n_books', [author.id for author in authors]))
+                return [len(author.books) for author in authors]
+
+        self.batches = batches = []
+        self.calls = calls = []
         self.root_node = RootNode([Books, Authors])
 
     def query(self, query):
@@ -324,3 +357,498 @@ class TestQueries(TestCase):
                 {'change_title': {'id': 4, 'title': 'AA'}}
             ]
         }
+
+    def test_compiled_plans_are_cached_per_schema(self):
+        query = 'books { id author { name } }'
+        plan = self.root_node.compile(query)
+        assert isinstance(plan, Selection)
+        assert self.root_node.compile(query) is plan
+        assert RootNode(self.root_node.nodes.values()).compile(query) is plan
+
+        [books] = plan
+        assert books.node is self.root_node.nodes['books']
+        [_, author] = books.fields
+        assert author.node is self.root_node.nodes['authors']
+        assert self.ungenerator(self.root_node.query(plan))['books'][0] == {
+            'id': 1, 'author': {'name': 'Grace'},
+        }
+
+    def test_missing_nested_fields_are_found_while_compiling(self):
+        with raises(MissingFields):
+            self.root_node.compile('authors { books { misingattr } }')
+
+    def test_compiled_serializers_output_the_same(self):
+        queries = [
+            'authors { id name books (title_contains: "El") { id title } }',
+            'books { id title author { name books { id } } }',
+            'books { change_title (title: "AA") { id title } }',
+        ]
+        expected = [self.query(query) for query in queries]
+        self.setUp()  # undo the mutations
+        for node in self.root_node.nodes.values():
+            node.Meta.compile_serializers = True
+        assert [self.query(query) for query in queries] == expected
+        assert self.query('books { id }')['books'][0] == {'id': 1}
+        assert Node.serialize(
+            self.root_node.nodes['books'](None, self.root_node.nodes),
+            {'id': 7, 'title': 'T'},
+            self.root_node.compile('books { title id }')[0].fields,
+        ) == {'title': 'T', 'id': 7}
+
+    def test_query_with_variables(self):
+        plan = self.root_node.compile("""
+            authors { books (title_contains: $title) { id } }
+        """)
+        assert plan.variables == {'title'}
+        data = self.ungenerator(self.root_node.query(plan, {'title': 'D'}))
+        assert data == {
+            'authors': [{'books': [{'id': 2}]}, {'books': [{'id': 4}]}]
+        }
+        with raises(MissingVariable):
+            self.root_node.query(plan)
+
+    def test_persisted_queries(self):
+        query = 'books (title_contains: $title) { id }'
+        registry = PersistedQueries.from_mapping({'books_by_title': query})
+        registry.compile(self.root_node.nodes.values())
+        assert registry.cache.stats()['misses'] == 1
+
+        root_node = RootNode(
+            self.root_node.nodes.values(), cache=registry.cache
+        )
+        for key in (query_id(query), 'books_by_title'):
+            data = root_node.query(
+                root_node.compile(registry.get(key)), {'title': 'Dun'}
+            )
+            assert self.ungenerator(data) == {'books': [{'id': 4}]}
+        assert registry.cache.stats()['hits'] == 2
+
+        with raises(UnknownQuery):
+            registry.get('coco')
+
+    def test_query_cost_analysis(self):
+        def cost(query):
+            return analyze(self.root_node.compile(query))
+
+        assert cost('books { id }') == Cost(depth=1, fan_out=0, rows=100)
+        assert cost('books (limit: 3) { author { name } }') == Cost(
+            depth=2, fan_out=1, rows=6,
+        )
+        assert cost('authors (ids: [1, 2]) { books { id } }') == Cost(
+            depth=2, fan_out=20, rows=42,
+        )
+        assert cost("""
+            authors {
+                books (limit: 2) { author { books { id } } }
+                id
+            }
+            books { id }
+        """) == Cost(depth=4, fan_out=20, rows=50 + 100 + 100 + 2000 + 100)
+
+    def test_queries_over_budget_are_rejected(self):
+        root_node = RootNode(
+            self.root_node.nodes.values(), budget=Budget(max_rows=200)
+        )
+        assert root_node.query('authors (limit: 1) { books { id } }')
+        with raises(QueryTooExpensive) as error:
+            root_node.query('authors { books { id } }')
+        assert str(error.value) == (
+            'Query is too expensive: its rows is 1050 and the maximum '
+            'allowed is 200.'
+        )
+
+    def test_one_node_instance_per_class_and_execution(self):
+        instances = []
+
+        class Counter:
+            def __init__(self, *args, **kwargs):
+                instances.append(self)
+                super().__init__(*args, **kwargs)
+
+        nodes = [
+            type(node.__name__, (Counter, node), {})
+            for node in self.root_node.nodes.values()
+        ]
+        root_node = RootNode(nodes)
+        execution = Execution(root_node.nodes)
+        data = self.ungenerator(root_node.query("""
+            authors { books { author { id } } }
+            books { author { books { id } } }
+        """, execution=execution))
+        assert data['authors'][0]['books'][0]['author'] == {'id': 32}
+        assert len(instances) == 2
+        assert set(execution.instances.values()) == set(instances)
+
+    def test_batched_fields_are_solved_once_per_level(self):
+        data = self.query("""
+            books (title_contains: "D") { id writer { name n_books } }
+        """)
+        assert data == {
+            'books': [
+                {'id': 2, 'writer': {'name': 'Grace', 'n_books': 2}},
+                {'id': 4, 'writer': {'name': 'John', 'n_books': 2}},
+            ]
+        }
+        assert self.batches == [('writer', [2, 4]), ('n_books', [32, 22])]
+
+        self.batches.clear()
+        data = self.query("""
+            authors {
+                books (title_contains: "El") {
+                    title
+                    writer { id n_books books { writer { id } } }
+                }
+            }
+        """)
+        assert [b['books'][0]['writer']['id'] for b in data['authors']] == [
+            32, 22,
+        ]
+        assert data['authors'][1]['books'][0]['writer']['books'] == [
+            {'writer': {'id': 22}}, {'writer': {'id': 22}},
+        ]
+        assert self.batches == [
+            ('writer', [1, 3]),
+            ('n_books', [32, 22]),
+            ('writer', [1, 2, 3, 4]),
+        ]
+
+    def test_normalized_format(self):
+        data = self.root_node.query("""
+            books { title author { signature } }
+            authors { name books { id } }
+        """, format='normalized')
+        assert data == {
+            'roots': {'books': [1, 2, 3, 4], 'authors': [32, 22]},
+            'entities': {
+                'books': {
+                    1: {'title': 'El becheló', 'author': 32, 'id': 1},
+                    2: {'title': 'Dog and Cat', 'author': 32, 'id': 2},
+                    3: {'title': 'El bocaza', 'author': 22, 'id': 3},
+                    4: {'title': 'Dungeon', 'author': 22, 'id': 4},
+                },
+                'authors': {
+                    32: {'signature': 'GRACE', 'name': 'Grace', 'books': [
+                        1, 2,
+                    ]},
+                    22: {'signature': 'JOHN', 'name': 'John', 'books': [
+                        3, 4,
+                    ]},
+                },
+            },
+        }
+        assert self.calls == [('signature', 32), ('signature', 22)]
+
+    def test_normalized_format_merges_nested_fields(self):
+        data = self.root_node.query("""
+            books { title author { books { title } } }
+            authors { books { n_pages } }
+        """, format='normalized')
+        assert data['entities']['books'][1] == {
+            'title': 'El becheló', 'author': 32, 'n_pages': 100,
+        }
+        assert data['entities']['authors'][32] == {'books': [1, 2]}
+
+    def test_normalized_entities_are_walked_once_per_selection(self):
+        books = self.root_node.nodes['authors']._fields['books']
+        with patch.object(books, 'resolve', wraps=books.resolve) as resolve:
+            self.root_node.query(
+                'books { author { books { title } } }', format='normalized',
+            )
+        assert resolve.call_count == 2
+
+    def test_normalized_items_without_id_are_inlined(self):
+        class Names(Node):
+            class Meta(Node.Meta):
+                name = 'names'
+                source = [{'name': 'a'}, {'name': 'b'}]
+
+            name = Field(str)
+
+        data = RootNode([Names]).query('names { name }', format='normalized')
+        assert data == {
+            'roots': {'names': [{'name': 'a'}, {'name': 'b'}]},
+            'entities': {},
+        }
+
+        with raises(UnknownFormat):
+            self.root_node.query('books { id }', format='coco')
+
+    def test_columnar_format(self):
+        data = self.root_node.query("""
+            authors { name books { title author { id } } }
+        """, format='columnar')
+        assert data == {'authors': {
+            'name': ['Grace', 'John'],
+            'books': {
+                '_parent': [0, 0, 1, 1],
+                'title': ['El becheló', 'Dog and Cat', 'El bocaza', 'Dungeon'],
+                'author': {'_parent': [0, 1, 2, 3], 'id': [32, 32, 22, 22]},
+            },
+        }}
+
+        data = self.root_node.query("""
+            books (title_contains: "D") { id writer { n_books } }
+        """, format='columnar')
+        assert data == {'books': {
+            'id': [2, 4], 'writer': {'_parent': [0, 1], 'n_books': [2, 2]},
+        }}
+
+    def test_columnar_format_with_numpy_arrays(self):
+        numpy = importorskip('numpy')
+        self.root_node.nodes['books'].Meta.numpy_columns = True
+        data = self.root_node.query(
+            'books { id title n_pages }', format='columnar',
+        )
+        assert isinstance(data['books']['id'], numpy.ndarray)
+        assert data['books']['n_pages'].tolist() == [100, 200, 300, 400]
+        assert isinstance(data['books']['title'], list)
+
+    def test_cached_fields(self):
+        with patch('carbon14.cache.time', return_value=0):
+            self.query('authors { summary (long: true) }')
+            data = self.query('authors { summary (long: true) }')
+            assert data['authors'][1] == {'summary': 'John: 2 books'}
+            assert self.calls == [('summary', 32, True), ('summary', 22, True)]
+
+            self.calls.clear()
+            self.query('authors { summary }')
+            self.query('authors { summary }')
+            assert self.calls == [
+                ('summary', 32, False), ('summary', 22, False),
+            ]
+
+        with patch('carbon14.cache.time', return_value=61):
+            self.calls.clear()
+            self.query('authors { summary }')
+            assert self.calls == [
+                ('summary', 32, False), ('summary', 22, False),
+            ]
+
+            self.root_node.nodes['authors'].summary.cache.invalidate(
+                'authors', 'summary', 22,
+            )
+            self.calls.clear()
+            self.query('authors { summary }')
+            assert self.calls == [('summary', 22, False)]
+
+    def test_cached_variants_are_entries_of_their_own(self):
+        field_cache = FieldCache(max_entries=4, scope=lambda ctx: ctx)
+
+        class Names(Node):
+            class Meta(Node.Meta):
+                name = 'names'
+                source = [{'id': 1, 'name': 'a'}]
+
+            @Field(str, cache=field_cache)
+            def greeting(self, item, **kwargs):
+                return f'{item["name"]} for {self.ctx}'
+
+        for user in range(10):
+            data = RootNode([Names], ctx=user).query('names { greeting }')
+            assert list(data['names']) == [{'greeting': f'a for {user}'}]
+        # evicted by the backend, not growing with the users
+        assert field_cache.backend.stats()['entries'] == 4
+
+        field_cache.invalidate('names', 'greeting', 1)
+        with patch.object(Names.greeting, 'solve') as solve:
+            list(RootNode([Names], ctx=9).query('names { greeting }')['names'])
+        assert solve.called
+
+    def test_items_without_pk_are_not_cached(self):
+        class Names(Node):
+            class Meta(Node.Meta):
+                name = 'names'
+                source = [{'name': 'a'}, {'name': 'b'}]
+
+            @Field(str, cache=FieldCache())
+            def upper(self, item, **kwargs):
+                return item['name'].upper()
+
+        data = RootNode([Names]).query('names { upper }')
+        assert list(data['names']) == [{'upper': 'A'}, {'upper': 'B'}]
+
+    def test_identical_subtrees_are_serialized_once(self):
+        execution = Execution(self.root_node.nodes)
+        data = self.ungenerator(self.root_node.query("""
+            books { author { signature books { id } } }
+        """, execution=execution))
+        grace = {'signature': 'GRACE', 'books': [{'id': 1}, {'id': 2}]}
+        john = {'signature': 'JOHN', 'books': [{'id': 3}, {'id': 4}]}
+        assert data == {'books': [
+            {'author': grace}, {'author': grace},
+            {'author': john}, {'author': john},
+        ]}
+        assert self.calls == [('signature', 32), ('signature', 22)]
+        assert execution.memo_hits == 2
+
+        # the same author with a different selection is not reused
+        self.calls.clear()
+        self.query('authors { signature books { author { signature } } }')
+        assert self.calls == [
+            ('signature', 32), ('signature', 32),
+            ('signature', 22), ('signature', 22),
+        ]
+
+    def test_tracing(self):
+        events = []
+
+        class Recorder(Tracer):
+            def start(self, kind, path):
+                events.append(('start', kind, path))
+
+            def end(self, kind, path, duration):
+                events.append(('end', kind, path))
+
+        self.root_node.tracer = Recorder()
+        self.root_node.query("""
+            books (title_contains: "Dog") { title author { name } }
+        """)
+        assert events == [
+            ('start', 'parse', ''),
+            ('end', 'parse', ''),
+            ('start', 'solve', 'books'),
+            ('start', 'filter', 'books'),
+            ('end', 'filter', 'books'),
+            ('start', 'resolve', 'books.title'),
+            ('end', 'resolve', 'books.title'),
+            ('start', 'resolve', 'books.author'),
+            ('end', 'resolve', 'books.author'),
+            ('start', 'related', 'books.author'),
+            ('start', 'resolve', 'books.author.name'),
+            ('end', 'resolve', 'books.author.name'),
+            ('end', 'related', 'books.author'),
+            ('end', 'solve', 'books'),
+        ]
+
+        collector = self.root_node.tracer = Collector()
+        self.root_node.query('books { title author { name } }')
+        timings = {(kind, path): t for kind, path, t in collector.report()}
+        assert timings['solve', 'books'].count == 1
+        assert timings['resolve', 'books.title'].count == 4
+        assert timings['related', 'books.author'].count == 4
+        # the authors are memoized, so each one is serialized once
+        assert timings['resolve', 'books.author.name'].count == 2
+        assert (
+            timings['solve', 'books'].total >=
+            timings['related', 'books.author'].total >=
+            timings['related', 'books.author'].max > 0
+        )
+
+    def test_queries_with_mutations_are_not_memoized(self):
+        execution = Execution(self.root_node.nodes)
+        data = self.ungenerator(self.root_node.query("""
+            books {
+                author { signature }
+                change_title (title: "AA") { title author { signature } }
+            }
+        """, execution=execution))
+        assert data['books'][1]['change_title']['title'] == 'AA'
+        assert execution.memo is None
+        assert len(self.calls) == 8
+
+
+class TestAsyncQueries(TestCase):
+
+    def setUp(self):
+        AUTHORS = [
+            Author(id=1, name='Grace', is_alive=True, books=[]),
+            Author(id=2, name='John', is_alive=True, books=[]),
+        ]
+        BOOKS = [
+            Book(id=1, title='A', n_pages=10, author_id=1),
+            Book(id=2, title='B', n_pages=20, author_id=2),
+        ]
+        self.calls = calls = set()
+
+        async def upstream(name, *others):
+            """Stand-in for a slow service, waits for the `others` calls"""
+            calls.add(name)
+            while not calls.issuperset(others):
+                await asyncio.sleep(0)
+            return name
+
+        class Books(Node):
+            class Meta(Node.Meta):
+                name = 'books'
+                source = BOOKS
+
+            id = Field(int)
+            title = Field(str)
+
+            async def filter(self, _source, **kwargs):
+                await upstream('books', 'authors')
+                return _source
+
+            @Field('authors', many=False)
+            async def author(self, book, **kwargs):
+                await asyncio.sleep(0)
+                return AUTHORS[book.author_id - 1]
+
+        class Authors(Node):
+            class Meta(Node.Meta):
+                name = 'authors'
+                source = AUTHORS
+
+            id = Field(int)
+            name = Field(str)
+
+            def filter(self, _source, **kwargs):
+                calls.add('authors')
+                return _source
+
+            @Field(str)
+            async def biography(self, author, **kwargs):
+                return await upstream(f'bio {author.id}', f'photo {author.id}')
+
+            @Field(str)
+            async def photo(self, author, **kwargs):
+                return await upstream(f'photo {author.id}', f'bio {author.id}')
+
+        self.root_node = RootNode([Books, Authors])
+
+    def aquery(self, query):
+        return asyncio.run(
+            asyncio.wait_for(self.root_node.aquery(query), timeout=1)
+        )
+
+    def test_sibling_fields_are_solved_concurrently(self):
+        data = self.aquery('authors { name biography photo }')
+        assert data == {
+            'authors': [
+                {'name': 'Grace', 'biography': 'bio 1', 'photo': 'photo 1'},
+                {'name': 'John', 'biography': 'bio 2', 'photo': 'photo 2'},
+            ]
+        }
+
+    def test_root_fields_are_solved_concurrently(self):
+        data = self.aquery("""
+            books { id author { name } }
+            authors { id }
+        """)
+        assert data == {
+            'books': [
+                {'id': 1, 'author': {'name': 'Grace'}},
+                {'id': 2, 'author': {'name': 'John'}},
+            ],
+            'authors': [{'id': 1}, {'id': 2}],
+        }
+        data = self.root_node.query('authors { id name }')
+        assert list(data['authors']) == [
+            {'id': 1, 'name': 'Grace'}, {'id': 2, 'name': 'John'},
+        ]
+
+    def test_cached_async_fields_store_their_values(self):
+        resolved = []
+
+        class Authors(self.root_node.nodes['authors']):
+            @Field(str, cache=FieldCache())
+            async def initial(self, author, **kwargs):
+                resolved.append(author.id)
+                await asyncio.sleep(0)
+                return author.name[0]
+
+        self.root_node = RootNode([Authors])
+        for _ in range(2):
+            data = self.aquery('authors { initial }')
+            assert data == {'authors': [{'initial': 'G'}, {'initial': 'J'}]}
+        assert resolved == [1, 2]